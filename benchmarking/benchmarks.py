@@ -28,6 +28,8 @@ def revert_list_dict(dictionary: Dict[str, Set[str]], filter_collection: Iterabl
 
 
 class Benchmark(ABC):
+    required_evaluators = ()
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper):
         self.vectors = embedding.vectors
@@ -148,6 +150,8 @@ class Benchmark(ABC):
 
 
 class CategoryBenchmark(Benchmark):
+    required_evaluators = (UMLSEvaluator,)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -232,6 +236,8 @@ class CategoryBenchmark(Benchmark):
 
 
 class SilhouetteCoefficient(Benchmark):
+    required_evaluators = (UMLSEvaluator,)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -309,6 +315,8 @@ class SilhouetteCoefficient(Benchmark):
 
 
 class EmbeddingSilhouetteCoefficient(Benchmark):
+    required_evaluators = (UMLSEvaluator,)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -390,6 +398,8 @@ class Relation(Enum):
 
 
 class ConceptualSimilarityChoi(Benchmark):
+    required_evaluators = (UMLSEvaluator, NDFEvaluator)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -467,6 +477,8 @@ class ConceptualSimilarityChoi(Benchmark):
 
 
 class MedicalRelatednessChoi(Benchmark, ABC):
+    required_evaluators = (UMLSEvaluator, NDFEvaluator)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  relation: Relation,
@@ -591,6 +603,8 @@ class HumanAssessmentTypes(Enum):
 
 
 class HumanAssessment(Benchmark):
+    required_evaluators = (SRSEvaluator,)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator],
@@ -770,6 +784,7 @@ class AbstractBeamBenchmark(Benchmark, ABC):
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper):
         super().__init__(embedding=embedding, umls_mapper=umls_mapper)
+        self.semantic_type_vocab_mask = None
 
     @staticmethod
     def sample(elements: List, bootstraps: int = 10):
@@ -792,6 +807,14 @@ class AbstractBeamBenchmark(Benchmark, ABC):
 
         return threshold
 
+    def get_concepts_of_semantic_types(self, semantic_types):
+        # union of the concepts of the types as id arrays of the semantic type index, restricted to the vocab
+        semantic_type_index = self.umls_evaluator.semantic_type_index
+        if self.semantic_type_vocab_mask is None:
+            self.semantic_type_vocab_mask = semantic_type_index.vocab_mask(self.vocab)
+        concept_ids = semantic_type_index.concepts_of_types(semantic_types)
+        return semantic_type_index.cuis[concept_ids[self.semantic_type_vocab_mask[concept_ids]]].tolist()
+
     @abstractmethod
     def calculate_power(self):
         pass
@@ -801,6 +824,8 @@ class AbstractBeamBenchmark(Benchmark, ABC):
 
 
 class SemanticTypeBeam(AbstractBeamBenchmark):
+    required_evaluators = (UMLSEvaluator,)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -871,6 +896,8 @@ class SemanticTypeBeam(AbstractBeamBenchmark):
 
 
 class NDFRTBeam(AbstractBeamBenchmark):
+    required_evaluators = (UMLSEvaluator, NDFEvaluator)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -883,14 +910,6 @@ class NDFRTBeam(AbstractBeamBenchmark):
             if isinstance(evaluator, NDFEvaluator):
                 self.ndf_evaluator = evaluator
 
-    def get_concepts_of_semantic_types(self, semantic_types):
-        concepts = set()
-        for semantic_type in semantic_types:
-            concepts.update([concept
-                             for concept in self.umls_evaluator.category2concepts[semantic_type]
-                             if concept in self.vocab])
-        return list(concepts)
-
     def calculate_power(self):
         total_positives = 0
         total_observed_scores = 0
@@ -957,6 +976,8 @@ class NDFRTBeam(AbstractBeamBenchmark):
 
 
 class CausalityBeam(AbstractBeamBenchmark):
+    required_evaluators = (UMLSEvaluator, MRRELEvaluator)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -969,14 +990,6 @@ class CausalityBeam(AbstractBeamBenchmark):
             if isinstance(evaluator, MRRELEvaluator):
                 self.mrrelevaluator = evaluator
 
-    def get_concepts_of_semantic_types(self, semantic_types):
-        concepts = set()
-        for semantic_type in semantic_types:
-            concepts.update([concept
-                             for concept in self.umls_evaluator.category2concepts[semantic_type]
-                             if concept in self.vocab])
-        return list(concepts)
-
     def calculate_power(self):
         total_positives = 0
         total_observed_scores = 0
@@ -1036,6 +1049,8 @@ class CausalityBeam(AbstractBeamBenchmark):
 
 
 class AssociationBeam(AbstractBeamBenchmark):
+    required_evaluators = (UMLSEvaluator, MRRELEvaluator)
+
     def __init__(self, embedding: Embedding,
                  umls_mapper: UMLSMapper,
                  evaluators: List[Evaluator]):
@@ -1048,14 +1063,6 @@ class AssociationBeam(AbstractBeamBenchmark):
             if isinstance(evaluator, MRRELEvaluator):
                 self.mrrelevaluator = evaluator
 
-    def get_concepts_of_semantic_types(self, semantic_types):
-        concepts = set()
-        for semantic_type in semantic_types:
-            concepts.update([concept
-                             for concept in self.umls_evaluator.category2concepts[semantic_type]
-                             if concept in self.vocab])
-        return list(concepts)
-
     def calculate_power(self):
         total_positives = 0
         total_observed_scores = 0
@@ -1,18 +1,24 @@
+import ast
 import os
 from collections import defaultdict
-from typing import List
+from itertools import chain
+from typing import List, Tuple, Union
 from resource.UMLS import UMLSMapper
 from benchmarking.benchmarks import Benchmark
-from resource.other_resources import Evaluator
+from resource.other_resources import Evaluator, EvaluatorRegistry
 import pandas as pd
 
 from vectorization.embeddings import Embedding
+from vectorization.quantization import QuantizedKeyedVectors
 
 
 class Evaluation:
+    quantization_columns = ['Data set', 'Algorithm', 'Preprocessing', 'Benchmark', 'Quantization', 'Score',
+                            'float32 Score', 'Score Difference']
+
     def __init__(self, embeddings: List[Embedding],
                  umls_mapper: UMLSMapper,
-                 evaluators: List[Evaluator],
+                 evaluators: Union[List[Evaluator], EvaluatorRegistry],
                  benchmark_classes=List[Benchmark]):
         self.benchmark_classes = benchmark_classes
         self.embeddings = embeddings
@@ -43,32 +49,94 @@ class Evaluation:
         df_table.to_csv(out_path, index=False, encoding="utf-8")
         return df_table
 
+    @staticmethod
+    def parse_score(score):
+        if isinstance(score, str):
+            return ast.literal_eval(score)
+        return score
+
+    @staticmethod
+    def score_difference(score, reference_score):
+        score = Evaluation.parse_score(score)
+        reference_score = Evaluation.parse_score(reference_score)
+        if isinstance(score, tuple):
+            return tuple(value - reference_value for value, reference_value in zip(score, reference_score))
+        return score - reference_score
+
+    @staticmethod
+    def find_reference_score(tuples: List[tuple], observation: tuple, cache_path: str):
+        # float32 score of the same embedding and benchmark, from this run or else from the benchmark cache
+        key = (observation[0], observation[1], observation[2], observation[8])
+        for reference in reversed(tuples):
+            if (reference[0], reference[1], reference[2], reference[8]) == key:
+                return reference[3]
+        if os.path.exists(cache_path):
+            cache_df = pd.read_csv(cache_path)
+            matches = cache_df[(cache_df["Data set"] == key[0]) & (cache_df["Algorithm"] == key[1])
+                               & (cache_df["Preprocessing"] == key[2]) & (cache_df["Benchmark"] == key[3])]
+            if len(matches) > 0:
+                return matches["Score"].iloc[-1]
+        return None
+
+    def umls_coverage(self, vocab) -> Tuple[int, int, float, float]:
+        german_cuis = self.umls_mapper.cui_set
+        nr_german_cuis = len(german_cuis)
+        nr_vectors = len(vocab)
+        nr_concepts = sum(1 for cui in german_cuis if cui in vocab)
+
+        cui_cov = nr_concepts / nr_vectors  # ratio of found umls terms vs all vocab entries
+        umls_cov = nr_concepts / nr_german_cuis  # ratio of found umls terms vs total UMLS terms
+        return nr_concepts, nr_vectors, cui_cov, umls_cov
+
+    def benchmark_evaluators(self, benchmark_class) -> List[Evaluator]:
+        if isinstance(self.evaluators, EvaluatorRegistry):
+            return self.evaluators.require(benchmark_class.required_evaluators)
+        return self.evaluators
+
     def evaluate(self):
         tuples = []
+        quantized_tuples = []
+        if isinstance(self.evaluators, EvaluatorRegistry):
+            # load everything the selected benchmarks need up front, in parallel
+            self.evaluators.require(chain.from_iterable(benchmark_class.required_evaluators
+                                                        for benchmark_class in self.benchmark_classes))
         for embedding in self.embeddings:
             embedding.load()
+            coverage = None
             cache_path = 'data/benchmark_cache.csv'
+            quantization_cache_path = 'data/benchmark_quantization_cache.csv'
             for benchmark_class in self.benchmark_classes:
-                benchmark = benchmark_class(embedding, self.umls_mapper, self.evaluators)
+                benchmark = benchmark_class(embedding, self.umls_mapper, self.benchmark_evaluators(benchmark_class))
                 score = benchmark.evaluate()
 
-                german_cuis = set(benchmark.umls_mapper.umls_reverse_dict.keys())
-                vocab_terms = set(benchmark.vocab.keys())
-                actual_umls_terms = german_cuis.intersection(vocab_terms)
-                nr_german_cuis = len(german_cuis)
-                nr_vectors = len(vocab_terms)
-                nr_concepts = len(actual_umls_terms)
-
-                cui_cov = nr_concepts / nr_vectors  # ratio of found umls terms vs all vocab entries
-                umls_cov = nr_concepts / nr_german_cuis  # ratio of found umls terms vs total UMLS terms
+                if coverage is None:
+                    coverage = self.umls_coverage(benchmark.vocab)
+                nr_concepts, nr_vectors, cui_cov, umls_cov = coverage
 
                 observation = (benchmark.dataset, benchmark.algorithm, benchmark.preprocessing, score,
                                nr_concepts, nr_vectors, cui_cov, umls_cov, benchmark.__class__.__name__,)
-                tuples.append(observation)
-                df_obs = pd.DataFrame([observation], columns=['Data set', 'Algorithm', 'Preprocessing', 'Score',
-                                                              '# Concepts', '# Words', 'CUI Coverage',
-                                                              'UMLS Coverage', 'Benchmark'])
-                df_obs.to_csv(cache_path, mode='a', header=(not os.path.exists(cache_path)), index=False)
+                # decided by what was loaded, a quantized .npz file is quantized without the constructor flag
+                quantization = embedding.vectors.quantization \
+                    if isinstance(embedding.vectors, QuantizedKeyedVectors) else None
+                if quantization:
+                    # quantized runs are kept out of the paper table and compared against float32 instead
+                    reference_score = self.find_reference_score(tuples, observation, cache_path)
+                    difference = None
+                    if reference_score is not None:
+                        difference = self.score_difference(score, reference_score)
+                    quantized_observation = (benchmark.dataset, benchmark.algorithm, benchmark.preprocessing,
+                                             benchmark.__class__.__name__, quantization, score,
+                                             reference_score, difference)
+                    quantized_tuples.append(quantized_observation)
+                    df_obs = pd.DataFrame([quantized_observation], columns=self.quantization_columns)
+                    df_obs.to_csv(quantization_cache_path, mode='a',
+                                  header=(not os.path.exists(quantization_cache_path)), index=False)
+                else:
+                    tuples.append(observation)
+                    df_obs = pd.DataFrame([observation], columns=['Data set', 'Algorithm', 'Preprocessing', 'Score',
+                                                                  '# Concepts', '# Words', 'CUI Coverage',
+                                                                  'UMLS Coverage', 'Benchmark'])
+                    df_obs.to_csv(cache_path, mode='a', header=(not os.path.exists(cache_path)), index=False)
                 benchmark.clean()
                 del benchmark
             embedding.clean()
@@ -80,3 +148,8 @@ class Evaluation:
         df.to_csv('data/benchmark_results1.csv', index=False, encoding="utf-8")
         df_table = Evaluation.build_paper_table(df, 'data/benchmark_results2.csv')
         print(df_table)
+
+        if len(quantized_tuples) > 0:
+            df_quantized = pd.DataFrame(quantized_tuples, columns=self.quantization_columns)
+            df_quantized.to_csv('data/benchmark_quantization_results.csv', index=False, encoding="utf-8")
+            print(df_quantized)
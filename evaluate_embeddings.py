@@ -2,7 +2,7 @@ from benchmarking.benchmarks import *
 from utils.transform_data import ConfigLoader
 from vectorization.embeddings import Embeddings, Embedding
 from benchmarking.evaluation import Evaluation
-from resource.other_resources import NDFEvaluator, SRSEvaluator
+from resource.other_resources import NDFEvaluator, SRSEvaluator, EvaluatorRegistry
 import pandas as pd
 
 
@@ -37,6 +37,9 @@ def main():
         Embedding('German_Medical_flair_no_cui_all.kv', "GerVec", "Flair", "SE CUI", estimate_cui=True),
         # Embedding('German_Medical_flair_no_finetune_no_cui_all.kv', "GerVec", "Flair", "SE CUI NF", estimate_cui=True),
         Embedding('German_Medical_bert_no_finetune_no_cui_all.kv', "GerVec", "BERT", "SE CUI NF", estimate_cui=True),
+        # quantized variants are compared against the float32 scores of the same embedding listed before them
+        # Embedding('German_Medical_bert_no_finetune_no_cui_all.kv', "GerVec", "BERT", "SE CUI NF", estimate_cui=True,
+        #           quantization="int8"),
         #
         # Embedding('100K_news_flair_all.kv', "News 100K", "Flair", "multi-term"),
         # Embedding('100K_news_flair_plain_all.kv', "News 100K", "Flair", "single-term"),
@@ -128,12 +131,12 @@ def main():
     # new glove julie
     # GGONC single term, multi term
 
-    evaluators = [
-        UMLSEvaluator(from_dir=config["PATH"]["UMLS"]),
-        NDFEvaluator(from_dir=config["PATH"]["NDF"]),
-        SRSEvaluator(from_dir=config["PATH"]["SRS"]),
-        MRRELEvaluator(from_dir=config["PATH"]["UMLS"])
-    ]
+    # evaluators are only loaded if one of the benchmarks to use requires them
+    evaluators = EvaluatorRegistry() \
+        .register(UMLSEvaluator, from_dir=config["PATH"]["UMLS"]) \
+        .register(NDFEvaluator, from_dir=config["PATH"]["NDF"]) \
+        .register(SRSEvaluator, from_dir=config["PATH"]["SRS"]) \
+        .register(MRRELEvaluator, from_dir=config["PATH"]["UMLS"])
 
     benchmarks_to_use = [
         HumanAssessmentRelatednessCont,
@@ -1,8 +1,14 @@
+import csv
 import os
-from collections import defaultdict
-from typing import Iterable, List, Dict, Union
+import pickle
+import sys
+from collections import OrderedDict
+from typing import Iterable, List, Dict, Union, Set, Tuple
 import json
+import multiprocessing
 import gensim
+import numpy as np
+from scipy.sparse import csr_matrix
 from simstring.database.dict import DictDatabase
 from simstring.feature_extractor.character_ngram import CharacterNgramFeatureExtractor
 from simstring.measure.cosine import CosineMeasure
@@ -10,32 +16,73 @@ from simstring.searcher import Searcher
 from tqdm import tqdm
 import pandas as pd
 from itertools import chain
-import spacy
-from spacy.matcher import PhraseMatcher
 
+from resource.fuzzy_matching import TfidfMatcher
+from resource.multiterm_matching import TokenAhoCorasick
 from resource.other_resources import Evaluator
+from utils.file_cache import FileCache
+from utils.resource_cache import ResourceCache
+from utils.shared_resources import ArrayMapping, SharedResources
+from utils.transform_data import DataHandler, SpacyModels
+
+MRCONSO_COLUMNS = ["CUI", "LAT", "TS", "LUI", "STT", "SUI", "ISPREF", "AUI", "SAUI", "SCUI", "SDUI", "SAB", "TTY",
+                   "CODE", "STR", "SRL", "SUPPRESS", "CVF"]
+
+_search_db = None
+_search_searcher = None
+_search_threshold = None
+
+
+def _init_search_worker(db_path: str, threshold: float):
+    global _search_db, _search_searcher, _search_threshold
+    if _search_db is None:
+        _search_db = UMLSMapper.load_db_snapshot(db_path)
+    _search_searcher = Searcher(_search_db, CosineMeasure())
+    _search_threshold = threshold
+
+
+def _search_terms(terms: List[str]) -> List[Tuple[str, List[str]]]:
+    return [(term, _search_searcher.search(term, _search_threshold)) for term in terms]
 
 
 class UMLSMapper:
     # https://www.ncbi.nlm.nih.gov/books/NBK9685/table/ch03.T.concept_names_and_sources_file_mr/
-    def __init__(self, from_dir: str = None, json_path: str = "mapper.json", umls_words: Iterable[str] = None):
+    source_files = ["GER_MRCONSO.RRF"]
+
+    def __init__(self, from_dir: str = None, json_path: str = "mapper.json", umls_words: Iterable[str] = None,
+                 search_cache_size: int = 1000000, fuzzy_engine: str = "simstring", shared: bool = False):
         # self.db = DictDatabase(WordNgramFeatureExtractor(2))
 
-        self.db = DictDatabase(CharacterNgramFeatureExtractor(2))
+        # the simstring index is only needed for fuzzy matching and is built (or loaded) on first access of self.db
+        self._db = None
+        self._searcher = None
+        self._tfidf_matcher = None
+        self._multiterm_matcher = None
+        self.fuzzy_engine = fuzzy_engine
+        self.similarity_threshold = 0.8
+        self.search_cache = OrderedDict()
+        self.search_cache_size = search_cache_size
+        self.db_words = None
+        self.db_path = None
+        self.json_path = None
+        self.version = None
 
         if from_dir:
             json_path = os.path.join(from_dir, json_path)
-            if os.path.exists(json_path):
-                print(f"initialize {self.__class__.__name__}... Load json")
-                self.umls_dict, self.umls_reverse_dict = self.load_from_json(json_path)
-                self.add_words_to_db(self.umls_dict.keys())
+            shared_dir = SharedResources.shared_dir(json_path)
+            if shared and SharedResources.is_current(shared_dir, json_path, from_dir, self.source_files):
+                print(f"initialize {self.__class__.__name__}... Attach shared resources")
+                self.umls_dict, self.umls_reverse_dict = SharedResources.attach(shared_dir)
             else:
-                print(f"initialize {self.__class__.__name__}... Load dir")
-                self.umls_dict, self.umls_reverse_dict = self.load_umls_dict(from_dir)
-                self.add_words_to_db(self.umls_dict.keys())
-                self.save_as_json(path=json_path)
+                self.umls_dict, self.umls_reverse_dict = self.load_cached_or_parse(from_dir, json_path)
+                if shared:
+                    self.umls_dict, self.umls_reverse_dict = SharedResources.publish(
+                        shared_dir, (self.umls_dict, self.umls_reverse_dict), json_path, from_dir, self.source_files)
+            self.build_index()
+            self.json_path = json_path
+            self.db_path = os.path.join(from_dir, "simstring_db.pkl")
         else:
-            self.add_words_to_db(umls_words)
+            self.db_words = set(umls_words)
 
         # if from_dir:
         #     print(f"initialize {self.__class__.__name__}... Load dir")
@@ -48,21 +95,94 @@ class UMLSMapper:
         # else:
         #     self.add_words_to_db(umls_words)
 
-    def load_umls_dict(self, directory):
+    def load_cached_or_parse(self, from_dir: str, json_path: str) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+        def save_json(path: str, data: tuple):
+            self.umls_dict, self.umls_reverse_dict = data
+            self.save_as_json(path=path)
+
+        return ResourceCache.load_or_parse(self.__class__.__name__, from_dir, json_path, self.source_files,
+                                           parse=self.load_umls_dict, load_json=self.load_from_json,
+                                           save_json=save_json)
+
+    def load_umls_dict(self, directory, languages: Iterable[str] = None, sources: Iterable[str] = None,
+                       term_types: Iterable[str] = None, chunk_size: int = 1000000):
         path = os.path.join(directory, "GER_MRCONSO.RRF")
-        df = pd.read_csv(path, delimiter="|", header=None)
-        df.columns = ["CUI", "LAT", "TS", "LUI", "STT", "SUI", "ISPREF", "AUI", "SAUI", "SCUI", "SDUI", "SAB", "TTY",
-                      "CODE", "STR", "SRL", "SUPPRESS", "CVF", "NONE"]
-        df = df.drop(columns=['NONE'])
-        dic = {row["STR"]: row["CUI"] for i, row in df.iterrows()}
-        rev_dic = defaultdict(list)
-        for key, value in dic.items():
-            rev_dic[value].append(key)
+        # only CUI and STR (plus the filtered columns) are parsed, chunk by chunk, so memory stays bounded by the
+        # size of the resulting dicts even for a full multilingual MRCONSO
+        filters = {column: set(values) for column, values in (("LAT", languages), ("SAB", sources),
+                                                              ("TTY", term_types)) if values}
+        columns = ["CUI", "STR"] + list(filters.keys())
+        reader = pd.read_csv(path, delimiter="|", header=None, usecols=[MRCONSO_COLUMNS.index(c) for c in columns],
+                             dtype=str, quoting=csv.QUOTE_NONE, keep_default_na=False, chunksize=chunk_size)
+        dic = {}
+        for chunk in tqdm(reader, desc="MRCONSO chunks"):
+            chunk.columns = [MRCONSO_COLUMNS[i] for i in chunk.columns]
+            for column, values in filters.items():
+                chunk = chunk[chunk[column].isin(values)]
+            # later rows overwrite earlier ones, like the row-wise dict construction did
+            dic.update(zip(chunk["STR"].values, chunk["CUI"].values))
+
+        terms = pd.DataFrame({"STR": list(dic.keys()), "CUI": list(dic.values())})
+        rev_dic = terms.groupby("CUI", sort=False)["STR"].agg(list).to_dict()
         return dic, rev_dic
 
+    def build_index(self):
+        if isinstance(self.umls_dict, ArrayMapping):
+            # memory mapped: the CUI values of the term dict are ids into the same sorted CUI table that holds the
+            # keys of the reverse dict, so they already are the CUI rows of the terms
+            self.cuis = self.umls_reverse_dict.key_table
+            self.cui_set = self.umls_reverse_dict
+            self.terms = self.umls_dict.key_table
+            self.term_cui_rows = self.umls_dict.value_ids
+            self.composition_matrices = None
+            return
+        # every term and CUI string exists once and is shared by the dicts and the index structures
+        self.umls_dict = {sys.intern(term): sys.intern(cui) for term, cui in self.umls_dict.items()}
+        self.umls_reverse_dict = {sys.intern(cui): [sys.intern(term) for term in terms]
+                                  for cui, terms in self.umls_reverse_dict.items()}
+        self.cuis = list(self.umls_reverse_dict.keys())
+        # only needed to code the terms, not kept, so the index has the same attributes in shared mode
+        cui2row = {cui: row for row, cui in enumerate(self.cuis)}
+        self.cui_set = frozenset(self.cuis)
+        self.terms = list(self.umls_dict.keys())
+        self.term_cui_rows = np.fromiter((cui2row[cui] for cui in self.umls_dict.values()),
+                                         dtype=np.int32, count=len(self.terms))
+        self.composition_matrices = None
+
+    def concept_composition_matrices(self) -> Tuple[List[str], csr_matrix, csr_matrix]:
+        # term x token counts and CUI x term incidence, compiled once and shared by all embeddings that estimate
+        # concept vectors from their term tokens
+        if self.composition_matrices is None:
+            token2column = {}
+            indptr = [0]
+            indices = []
+            for term in self.terms:
+                for token in term.split():
+                    indices.append(token2column.setdefault(token, len(token2column)))
+                indptr.append(len(indices))
+            term_tokens = csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                                     shape=(len(self.terms), len(token2column)))
+            term_tokens.sum_duplicates()
+            concept_terms = csr_matrix((np.ones(len(self.terms), dtype=np.float32),
+                                        (self.term_cui_rows, np.arange(len(self.terms)))),
+                                       shape=(len(self.cuis), len(self.terms)))
+            self.composition_matrices = list(token2column.keys()), term_tokens, concept_terms
+        return self.composition_matrices
+
+    def fingerprint(self) -> str:
+        # content hash of the mapping, used to key caches derived from it (e.g. estimated concept vectors)
+        if self.version is None:
+            if self.json_path and os.path.exists(self.json_path):
+                self.version = FileCache.memoized_hash(self.json_path)
+            else:
+                self.version = FileCache.hash_strings(*sorted(self.umls_dict.items()))
+        return self.version
+
+    def matcher_path(self) -> Union[str, None]:
+        return None if self.json_path is None else f'{self.json_path}.matcher'
+
     def save_as_json(self, path: str):
-        data = self.__dict__
-        data.pop("db")
+        data = {"umls_dict": self.umls_dict, "umls_reverse_dict": self.umls_reverse_dict}
         with open(path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=0)
 
@@ -71,50 +191,182 @@ class UMLSMapper:
             data = json.loads(file.read())
         return data["umls_dict"], data["umls_reverse_dict"]
 
+    @property
+    def db(self) -> DictDatabase:
+        if self._db is None:
+            if self.db_path and FileCache.is_valid(self.db_path, self.json_path):
+                print(f"load simstring index {self.db_path}...")
+                self._db = self.load_db_snapshot(self.db_path)
+            else:
+                print("build simstring index...")
+                self._db = DictDatabase(CharacterNgramFeatureExtractor(2))
+                self.add_words_to_db(self.umls_dict.keys() if self.db_words is None else self.db_words)
+                if self.db_path:
+                    self.save_db_snapshot(self._db, self.db_path, self.json_path)
+        return self._db
+
+    @staticmethod
+    def save_db_snapshot(db: DictDatabase, path: str, source_path: str):
+        # plain dicts and sets only, so the snapshot does not depend on the defaultdict factories of simstring
+        snapshot = {"strings": db.strings,
+                    "sizes": dict(db.feature_set_size_to_string_map),
+                    "features": {size: dict(features)
+                                 for size, features in db.feature_set_size_and_feature_to_string_map.items()}}
+
+        def writer(cache_path: str):
+            with open(cache_path, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        FileCache.write(path, source_path, writer)
+
+    @staticmethod
+    def load_db_snapshot(path: str) -> DictDatabase:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        db = DictDatabase(CharacterNgramFeatureExtractor(2))
+        db.strings = snapshot["strings"]
+        db.feature_set_size_to_string_map.update(snapshot["sizes"])
+        for size, features in snapshot["features"].items():
+            db.feature_set_size_and_feature_to_string_map[size].update(features)
+        return db
+
     def add_words_to_db(self, words: Iterable[str]):
         for token in set(words):
             self.db.add(token)
 
-    def search_term_sims(self, term: str) -> List[str]:
-        searcher = Searcher(self.db, CosineMeasure())
-        return searcher.search(term, 0.8)
+    @property
+    def searcher(self) -> Searcher:
+        # one searcher per mapper (and per worker process), it also memoizes the feature lookups in the index
+        if self._searcher is None:
+            self._searcher = Searcher(self.db, CosineMeasure())
+        return self._searcher
+
+    @property
+    def tfidf_matcher(self) -> TfidfMatcher:
+        if self._tfidf_matcher is None:
+            print("build tfidf index...")
+            self._tfidf_matcher = TfidfMatcher(self.umls_dict.keys() if self.db_words is None else self.db_words,
+                                               threshold=self.similarity_threshold)
+        return self._tfidf_matcher
 
-    def search_all_term_sims(self, terms: List[str]) -> Dict[str, List[str]]:
-        dic = {}
-        for term in set(terms):
-            related_terms = self.search_term_sims(term)
-            if len(related_terms) > 0:
-                dic[term] = related_terms
-        return dic
-        # return {term: self.search_term_sims(term) for term in set(terms)}
-
-    def standardize_words(self, tokens: List[str]):
-        concept_dict = self.search_all_term_sims(tokens)
-        standardized_tokens = []
-        for token in tokens:
-            mapping = concept_dict.get(token)
-            if mapping:
-                standardized_tokens.append(mapping[0])
+    def search_term_sims(self, term: str) -> List[str]:
+        related_terms = self.search_cache.get(term)
+        if related_terms is None:
+            if self.fuzzy_engine == "tfidf":
+                related_terms = self.tfidf_matcher.search(term)
             else:
-                standardized_tokens.append(token)
-        return standardized_tokens
-
-    def standardize_documents(self, documents: List[List[str]]):
-        concept_dict = self.search_all_term_sims(list(chain(*documents)))
-        standardized_documents = []
-        for document in tqdm(documents):
-            standardized_tokens = []
-            for token in document:
-                mapping = concept_dict.get(token)
-                if mapping:
-                    standardized_tokens.append(mapping[0])
-                else:
-                    standardized_tokens.append(token)
-                standardized_documents.append(standardized_tokens)
-        return standardized_documents
+                related_terms = self.searcher.search(term, self.similarity_threshold)
+            self.memoize_search(term, related_terms)
+        else:
+            self.search_cache.move_to_end(term)
+        return related_terms
+
+    def memoize_search(self, term: str, related_terms: List[str]):
+        self.search_cache[term] = related_terms
+        if len(self.search_cache) > self.search_cache_size:
+            self.search_cache.popitem(last=False)
+
+    def search_all_term_sims(self, terms: Iterable[str], workers: int = 1,
+                             batch_size: int = 1000) -> Dict[str, List[str]]:
+        terms = set(terms)
+        results = {term: self.search_cache[term] for term in terms if term in self.search_cache}
+        pending = [term for term in terms if term not in results]
+
+        # workers get the index by fork, or load the snapshot if processes are spawned
+        can_share_db = self.db_path is not None or multiprocessing.get_start_method() == 'fork'
+        if self.fuzzy_engine == "tfidf":
+            for term, related_terms in self.tfidf_matcher.search_all(pending).items():
+                self.memoize_search(term, related_terms)
+                results[term] = related_terms
+        elif workers > 1 and len(pending) > batch_size and can_share_db:
+            global _search_db
+            _search_db = self.db
+            batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+            with multiprocessing.Pool(workers, initializer=_init_search_worker,
+                                      initargs=(self.db_path, self.similarity_threshold)) as pool:
+                for batch_results in tqdm(pool.imap_unordered(_search_terms, batches), total=len(batches),
+                                          desc="fuzzy search"):
+                    for term, related_terms in batch_results:
+                        self.memoize_search(term, related_terms)
+                        results[term] = related_terms
+            _search_db = None
+        else:
+            for term in tqdm(pending, desc="fuzzy search", disable=len(pending) < batch_size):
+                results[term] = self.search_term_sims(term)
+
+        return {term: related_terms for term, related_terms in results.items() if len(related_terms) > 0}
+
+    @staticmethod
+    def print_report(report: Dict[str, float]):
+        print(', '.join(f'{key}: {value:.4f}' if isinstance(value, float) else f'{key}: {value}'
+                        for key, value in report.items()))
+
+    def fuzzy_engine_agreement(self, terms: Iterable[str], workers: int = 1) -> Dict[str, float]:
+        # compares the tfidf engine against the simstring results on the same (unique) terms, plus variants with
+        # bigrams no UMLS term contains as regression cases for the query normalization
+        terms = set(terms)
+        terms.update(self.tfidf_matcher.unseen_bigram_queries(sorted(terms)))
+        engine, cache = self.fuzzy_engine, self.search_cache
+        self.search_cache = OrderedDict()
+        try:
+            self.fuzzy_engine = "simstring"
+            reference = self.search_all_term_sims(terms, workers=workers)
+            candidate = self.tfidf_matcher.search_all(terms)
+        finally:
+            self.fuzzy_engine, self.search_cache = engine, cache
+        report = TfidfMatcher.agreement(reference, candidate, terms)
+        self.print_report(report)
+        return report
+
+    def standardization_mapping(self, tokens: Iterable[str], workers: int = 1) -> Dict[str, str]:
+        # only the best hit is used for standardization, so only that one is kept for the (large) type set
+        return {token: related_terms[0]
+                for token, related_terms in self.search_all_term_sims(tokens, workers=workers).items()}
+
+    def standardize_words(self, tokens: List[str], workers: int = 1):
+        mapping = self.standardization_mapping(tokens, workers=workers)
+        return [mapping.get(token, token) for token in tokens]
+
+    @staticmethod
+    def iter_standardized_documents(documents: Iterable[List[str]], mapping: Dict[str, str]) -> Iterable[List[str]]:
+        for document in documents:
+            yield [mapping.get(token, token) for token in document]
+
+    def standardize_documents(self, documents: Iterable[List[str]], workers: int = 1) -> Iterable[List[str]]:
+        # two passes (types, then documents) like standardize_file, so documents has to be re-iterable (a list, a
+        # ShardedCorpus, ...); the standardized documents are generated lazily, wrap them in list() if needed
+        if iter(documents) is documents:
+            raise UserWarning('standardize_documents needs a re-iterable corpus, not a one-shot iterator')
+        types = set()
+        for document in documents:
+            types.update(document)
+        mapping = self.standardization_mapping(types, workers=workers)
+        return self.iter_standardized_documents(documents, mapping)
+
+    def standardize_file(self, input_path: str, output_path: str, workers: int = 1, encoding="utf-8") -> int:
+        # two streaming passes over the corpus (types, then documents), memory only grows with the number of types
+        types = set()
+        for line in tqdm(DataHandler.iter_lines(input_path, encoding=encoding), desc="collect types"):
+            types.update(line.split())
+        mapping = self.standardization_mapping(types, workers=workers)
+
+        documents = (line.split() for line in DataHandler.iter_lines(input_path, encoding=encoding))
+        written = 0
+        with open(output_path, 'w', encoding=encoding) as f:
+            for document in tqdm(self.iter_standardized_documents(documents, mapping), desc="standardize"):
+                f.write(f'{" ".join(document)}\n')
+                written += 1
+        return written
+
+    def vocabulary_keep_set(self, include_term_tokens: bool = False) -> Set[str]:
+        keep = set(self.cui_set)
+        if include_term_tokens:
+            for term in self.umls_dict.keys():
+                keep.update(term.split())
+        return keep
 
     def get_umls_vectors_only(self, vectors: gensim.models.KeyedVectors):
-        medical_concepts = [word for word in vectors.index2word if word in self.umls_dict.values()]
+        medical_concepts = [word for word in vectors.index2word if word in self.cui_set]
         concept_vecs = {concept: vectors.get_vector(concept) for concept in medical_concepts}
         return concept_vecs
 
@@ -144,77 +396,197 @@ class UMLSMapper:
     def replace_with_umls(self, tokens: List[str], delete_non_umls=False) -> List[str]:
         return [self.umls_code(token, delete_non_umls) for token in tokens if self.umls_code(token, delete_non_umls)]
 
+    def iter_replace_documents_token_based(self, documents: Iterable[str], delete_non_umls=False,
+                                           tokenize: bool = True) -> Iterable[Union[List[str], str]]:
+        for sentence in documents:
+            codes = [code for code in (self.umls_code(token, delete_non_umls) for token in sentence.split()) if code]
+            yield codes if tokenize else ' '.join(codes)
+
     def replace_documents_token_based(self, documents: List[str], delete_non_umls=False, tokenize: bool = True) \
             -> Union[List[List[str]], List[str]]:
-        tokenized_documents = [sentence.split() for sentence in documents]
-        if tokenize:
-            return [[self.umls_code(token, delete_non_umls) for token in tokens if self.umls_code(token, delete_non_umls)]
-                    for tokens in tokenized_documents]
-        else:
-            return [' '.join([self.umls_code(token, delete_non_umls)
-                              for token in tokens if self.umls_code(token, delete_non_umls)])
-                    for tokens in tokenized_documents]
+        return list(self.iter_replace_documents_token_based(documents, delete_non_umls=delete_non_umls,
+                                                            tokenize=tokenize))
 
-    def spacy_tokenize(self, documents: List["str"], nlp=None) -> List[List[str]]:
+    @staticmethod
+    def iter_spacy_tokenize(documents: Iterable[str], nlp=None, n_process: int = 1,
+                            batch_size: int = 1000) -> Iterable[List[str]]:
         if nlp is None:
-            nlp = spacy.load('de_core_news_sm')
-        doc_pipe = list(nlp.pipe(documents, disable=["tagger", "parser", "ner"]))
-        tokenized_docs = [[token.text for token in doc] for doc in tqdm(doc_pipe, desc="Tokenize", total=len(documents))]
-        return tokenized_docs
-
-    def replace_documents_with_spacy_multiterm(self, documents: List[str], tokenize: bool = True) -> List[List[str]]:
-        nlp = spacy.load('de_core_news_sm')
-        matcher = PhraseMatcher(nlp.vocab)
-        terms = self.umls_dict.keys()
-        doc_pipe = list(nlp.pipe(documents, disable=["tagger", "parser", "ner"]))
-        # Only run nlp.make_doc to speed things up
-        patterns = [nlp.make_doc(term) for term in terms]
-        matcher.add("TerminologyList", None, *patterns)
-        replaced_docs = []
-
-        for doc in tqdm(doc_pipe, desc="Replace with concepts", total=len(documents)):
-            text_doc = doc.text
-            matches = matcher(doc)
-            concepts = []
-            for match_id, start, end in matches:
-                span = doc[start:end]
-                concepts.append(span.text)
-
-            concepts.sort(key=lambda s: len(s), reverse=True)
-            for concept in concepts:
-                text_doc = text_doc.replace(concept, self.umls_dict[concept])
-
-            replaced_docs.append(text_doc)
-
-            # tokens = [token for token in text_doc.split()]
-            # replaced_docs.append(tokens)
+            nlp = SpacyModels.get('de_core_news_sm', disable=SpacyModels.TOKENIZER_ONLY)
+        for doc in DataHandler.tokenized_docs(nlp, documents, n_process=n_process, batch_size=batch_size):
+            yield [token.text for token in doc]
+
+    def spacy_tokenize(self, documents: List["str"], nlp=None, n_process: int = 1,
+                       batch_size: int = 1000) -> List[List[str]]:
+        return list(tqdm(self.iter_spacy_tokenize(documents, nlp, n_process=n_process, batch_size=batch_size),
+                         desc="Tokenize", total=len(documents)))
+
+    def iter_replace_documents_with_spacy_multiterm(self, documents: Iterable[str], tokenize: bool = True,
+                                                    n_process: int = 1, batch_size: int = 1000) -> Iterable:
+        # documents are streamed through the (multi process) tokenizer, matched and replaced one by one and, if
+        # requested, streamed through the tokenizer again, so no stage holds the corpus
+        nlp = SpacyModels.get('de_core_news_sm', disable=SpacyModels.TOKENIZER_ONLY)
+        matcher = DataHandler.phrase_matcher(nlp, self.umls_dict.keys(), cache_path=self.matcher_path(),
+                                             source_path=self.json_path)
+        replaced_docs = (DataHandler.replace_matches(doc, matcher(doc), self.umls_dict)
+                         for doc in DataHandler.tokenized_docs(nlp, documents, n_process=n_process,
+                                                               batch_size=batch_size))
         if tokenize:
-            replaced_docs = self.spacy_tokenize(replaced_docs, nlp)
-        # doc_pipe = list(nlp.pipe(replaced_docs, disable=["tagger", "parser", "ner"]))
-        # replaced_docs = [[token.text for token in doc] for doc in tqdm(doc_pipe, desc="Tokenize", total=len(documents))]
-
+            replaced_docs = self.iter_spacy_tokenize(replaced_docs, nlp, n_process=n_process, batch_size=batch_size)
         return replaced_docs
 
+    def replace_documents_with_spacy_multiterm(self, documents: List[str], tokenize: bool = True,
+                                               n_process: int = 1, batch_size: int = 1000) -> List[List[str]]:
+        return list(tqdm(self.iter_replace_documents_with_spacy_multiterm(documents, tokenize=tokenize,
+                                                                           n_process=n_process,
+                                                                           batch_size=batch_size),
+                         desc="Replace with concepts", total=len(documents)))
+
+    @property
+    def multiterm_matcher(self) -> TokenAhoCorasick:
+        if self._multiterm_matcher is None:
+            self._multiterm_matcher = TokenAhoCorasick(self.umls_dict)
+        return self._multiterm_matcher
+
+    def replace_documents_aho_corasick(self, documents: List[str], tokenize: bool = True) \
+            -> Union[List[List[str]], List[str]]:
+        return list(tqdm(self.multiterm_matcher.replace_documents(documents, tokenize=tokenize),
+                         desc="Replace with concepts", total=len(documents)))
+
+    def multiterm_parity(self, documents: List[str]) -> Dict[str, float]:
+        # the spaCy PhraseMatcher path is the reference for the Aho-Corasick engine
+        reference = self.replace_documents_with_spacy_multiterm(documents, tokenize=True)
+        candidate = self.replace_documents_aho_corasick(documents, tokenize=True)
+        report = TokenAhoCorasick.parity(reference, candidate, self.cui_set)
+        self.print_report(report)
+        return report
+
+
+class SemanticTypeIndex:
+    # integer coded CUI <-> semantic type incidence in CSR layout in both directions (indptr/indices per row), so
+    # type lookups and set operations over concepts are NumPy operations on id arrays instead of string dicts
+    ARRAYS = ("cuis", "types", "cui_type_indptr", "cui_type_indices", "type_cui_indptr", "type_cui_indices")
+
+    def __init__(self, cuis: np.ndarray, types: np.ndarray, cui_type_indptr: np.ndarray, cui_type_indices: np.ndarray,
+                 type_cui_indptr: np.ndarray, type_cui_indices: np.ndarray):
+        self.cuis = cuis
+        self.types = types
+        self.cui_type_indptr, self.cui_type_indices = cui_type_indptr, cui_type_indices
+        self.type_cui_indptr, self.type_cui_indices = type_cui_indptr, type_cui_indices
+
+    @staticmethod
+    def sorted_ids(table: np.ndarray, values: Iterable[str]) -> np.ndarray:
+        # positions of the values in a sorted (np.unique) string table, -1 for values it does not contain
+        values = np.asarray(list(values), dtype=str)
+        if len(table) == 0 or len(values) == 0:
+            return np.full(len(values), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(table, values), len(table) - 1)
+        return np.where(table[positions] == values, positions, -1).astype(np.int64)
+
+    @classmethod
+    def from_pairs(cls, pair_cuis: np.ndarray, pair_types: np.ndarray) -> "SemanticTypeIndex":
+        cuis, cui_ids = np.unique(pair_cuis, return_inverse=True)
+        types, type_ids = np.unique(pair_types, return_inverse=True)
+        incidence = csr_matrix((np.ones(len(cui_ids), dtype=np.int8), (cui_ids, type_ids)),
+                               shape=(len(cuis), len(types)))
+        incidence.sum_duplicates()
+        incidence.sort_indices()
+        transposed = incidence.T.tocsr()
+        transposed.sort_indices()
+        return cls(cuis, types, incidence.indptr.astype(np.int64), incidence.indices.astype(np.int32),
+                   transposed.indptr.astype(np.int64), transposed.indices.astype(np.int32))
+
+    @classmethod
+    def from_dict(cls, concept2category: Dict[str, List[str]]) -> "SemanticTypeIndex":
+        lengths = np.fromiter((len(categories) for categories in concept2category.values()), dtype=np.int64,
+                              count=len(concept2category))
+        pair_cuis = np.repeat(np.array(list(concept2category.keys()), dtype=str), lengths)
+        pair_types = np.array(list(chain.from_iterable(concept2category.values())), dtype=str)
+        return cls.from_pairs(pair_cuis, pair_types)
+
+    def save_npz(self, path: str):
+        np.savez(path, cuis=self.cuis, types=self.types,
+                 cui_type_indptr=self.cui_type_indptr, cui_type_indices=self.cui_type_indices,
+                 type_cui_indptr=self.type_cui_indptr, type_cui_indices=self.type_cui_indices)
+
+    @classmethod
+    def load_npz(cls, path: str) -> "SemanticTypeIndex":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["cuis"], data["types"], data["cui_type_indptr"], data["cui_type_indices"],
+                       data["type_cui_indptr"], data["type_cui_indices"])
+
+    def save_npy_dir(self, directory: str):
+        # one .npy per array, unlike an npz they can be memory mapped and shared by worker processes
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+
+    @classmethod
+    def load_npy_dir(cls, directory: str) -> "SemanticTypeIndex":
+        return cls(*(np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in cls.ARRAYS))
+
+    def cui_ids(self, cuis: Iterable[str]) -> np.ndarray:
+        # -1 for CUIs without semantic type
+        return self.sorted_ids(self.cuis, cuis)
+
+    def type_ids(self, semantic_types: Iterable[str]) -> np.ndarray:
+        type_ids = self.sorted_ids(self.types, semantic_types)
+        return type_ids[type_ids >= 0]
+
+    def types_of(self, cui_id: int) -> np.ndarray:
+        return self.cui_type_indices[self.cui_type_indptr[cui_id]:self.cui_type_indptr[cui_id + 1]]
+
+    def concepts_of(self, type_id: int) -> np.ndarray:
+        return self.type_cui_indices[self.type_cui_indptr[type_id]:self.type_cui_indptr[type_id + 1]]
+
+    def concepts_of_types(self, semantic_types: Iterable[str]) -> np.ndarray:
+        # sorted union of the CUI ids of all given types
+        type_ids = self.type_ids(semantic_types)
+        if len(type_ids) == 0:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate([self.concepts_of(type_id) for type_id in type_ids]))
+
+    def vocab_mask(self, vocab) -> np.ndarray:
+        return np.fromiter((cui in vocab for cui in self.cuis.tolist()), dtype=bool, count=len(self.cuis))
+
 
 class UMLSEvaluator(Evaluator):
+    source_files = ["MRSTY.RRF"]
+
     def set_attributes(self, *args):
         self.concept2category, self.category2concepts = args
 
-    def __init__(self, from_dir: str = None, json_path: str = "umls_eval.json"):
+    def __init__(self, from_dir: str = None, json_path: str = "umls_eval.json", shared: bool = False):
         self.concept2category, self.category2concepts = None, None
-        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path)
+        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path, shared=shared)
+        # set after the json is written, the index is persisted separately (npz, or memory mapped .npy when shared)
+        self.semantic_type_index = None
+        if from_dir:
+            self.semantic_type_index = self.load_semantic_type_index(os.path.join(from_dir, json_path), shared=shared)
+        elif self.concept2category is not None:
+            self.semantic_type_index = SemanticTypeIndex.from_dict(self.concept2category)
+
+    def load_semantic_type_index(self, json_path: str, shared: bool = False) -> SemanticTypeIndex:
+        if shared:
+            # memory mapped next to the shared dicts, so workers do not each load a copy of the index
+            index_dir = os.path.join(SharedResources.shared_dir(json_path), "semantic_type_index")
+            if not FileCache.is_valid(index_dir, json_path):
+                FileCache.write(index_dir, json_path, SemanticTypeIndex.from_dict(self.concept2category).save_npy_dir)
+            if FileCache.is_valid(index_dir, json_path):
+                return SemanticTypeIndex.load_npy_dir(index_dir)
+        npz_path = f'{os.path.splitext(json_path)[0]}.npz'
+        if FileCache.is_valid(npz_path, json_path):
+            return SemanticTypeIndex.load_npz(npz_path)
+        semantic_type_index = SemanticTypeIndex.from_dict(self.concept2category)
+        FileCache.write(npz_path, json_path, semantic_type_index.save_npz)
+        return semantic_type_index
 
     def load_semantics(self, directory):
         path = os.path.join(directory, "MRSTY.RRF")
-        df = pd.read_csv(path, delimiter="|", header=None)
-        df.columns = ["CUI", "TUI", "STN", "STY", "ATUI", "CVF", "NONE"]
-        df = df.drop(columns=['NONE'])
-        concept2category = defaultdict(list)
-        category2concepts = defaultdict(list)
-
-        for i, row in tqdm(df.iterrows(), total=len(df), desc="Load UMLS data"):
-            concept2category[row["CUI"]].append(row["STY"])
-            category2concepts[row["STY"]].append(row["CUI"])
+        df = pd.read_csv(path, delimiter="|", header=None, usecols=[0, 3], names=["CUI", "STY"], dtype=str,
+                         quoting=csv.QUOTE_NONE, keep_default_na=False)
+        df = df.drop_duplicates()
+        concept2category = df.groupby("CUI", sort=False)["STY"].agg(list).to_dict()
+        category2concepts = df.groupby("STY", sort=False)["CUI"].agg(list).to_dict()
         return concept2category, category2concepts
 
     def load_from_json(self, path: str):
@@ -224,41 +596,38 @@ class UMLSEvaluator(Evaluator):
 
 
 class MRRELEvaluator(Evaluator):
+    source_files = ["MRREL.RRF"]
+    cause_relations = ['induces', 'cause_of', 'causative_agent_of']
+    association_relations = ['associated_disease', 'associated_finding_of', 'clinically_associated_with']
+
     def set_attributes(self, *args):
         self.mrrel_cause, self.mrrel_association = args
 
-    def __init__(self, from_dir: str = None, json_path: str = "umls_rel_eval.json"):
+    def __init__(self, from_dir: str = None, json_path: str = "umls_rel_eval.json", shared: bool = False):
         self.mrrel_cause = None
         self.mrrel_association = None
-        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path)
+        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path, shared=shared)
 
-    def load_semantics(self, directory):
+    def load_semantics(self, directory, chunk_size: int = 5000000):
         path = os.path.join(directory, "MRREL.RRF")
-        df = pd.read_csv(path, delimiter="|", header=None)
-        df.columns = ["CUI1", "AUI1", "STYPE1", "REL", "CUI2", "AUI2", "STYPE2", "RELA", "RUI", "SRUI", "SAB", "SL",
-                      "RG", "DIR", "SUPPRESS", "CVF", "NONE"]
-        df = df.drop(columns=["AUI1", "REL", "STYPE1", "AUI2", "STYPE2", "RUI", "SRUI", "SAB", "SL",
-                              "RG", "DIR", "SUPPRESS", "CVF", "NONE"])
-
-        df_cause = df.loc[df['RELA'].isin(['induces', 'cause_of', 'causative_agent_of'])]
-        print(df_cause.head(100))
-
-        mrrel_cause = defaultdict(list)
-
-        for i, row in tqdm(df_cause.iterrows(), total=len(df_cause), desc="Find causative data"):
-            mrrel_cause[row["CUI1"]].append(row["CUI2"])
-
-        df_association = df.loc[df['RELA'].isin(['associated_disease', 'associated_finding_of',
-                                                 'clinically_associated_with'])]
-        print(df_association.head(100))
-
-        mrrel_association = defaultdict(list)
-
-        for i, row in tqdm(df_association.iterrows(), total=len(df_association), desc="Find association data"):
-            mrrel_association[row["CUI1"]].append(row["CUI2"])
-
-        mrrel_cause = {key: list(dict.fromkeys(values)) for key, values in mrrel_cause.items()}
-        mrrel_association = {key: list(dict.fromkeys(values))for key, values in mrrel_association.items()}
+        wanted_relations = self.cause_relations + self.association_relations
+        # only CUI1, CUI2 and RELA are parsed and every chunk is reduced to the wanted relations before it is kept
+        reader = pd.read_csv(path, delimiter="|", header=None, usecols=[0, 4, 7], names=["CUI1", "CUI2", "RELA"],
+                             dtype={"CUI1": "category", "CUI2": "category", "RELA": "category"},
+                             quoting=csv.QUOTE_NONE, keep_default_na=False, chunksize=chunk_size)
+        chunks = []
+        for chunk in tqdm(reader, desc="Load MRREL chunks"):
+            chunk = chunk[chunk["RELA"].isin(wanted_relations)].astype(str)
+            chunks.append(chunk.drop_duplicates())
+        df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=["CUI1", "CUI2", "RELA"])
+
+        def related_concepts(relations: List[str]) -> Dict[str, List[str]]:
+            df_relation = df.loc[df["RELA"].isin(relations), ["CUI1", "CUI2"]].drop_duplicates()
+            print(df_relation.head(100))
+            return df_relation.groupby("CUI1", sort=False)["CUI2"].agg(list).to_dict()
+
+        mrrel_cause = related_concepts(self.cause_relations)
+        mrrel_association = related_concepts(self.association_relations)
 
         return mrrel_cause, mrrel_association
 
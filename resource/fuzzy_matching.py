@@ -0,0 +1,144 @@
+from collections import Counter
+from itertools import chain, islice
+from typing import Iterable, List, Dict, Tuple
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from tqdm import tqdm
+
+
+class TfidfMatcher:
+    # Batch alternative to the simstring searcher: terms and queries are sparse character bigram vectors (padded with
+    # a space like simstring does), so the dot products of a block of queries with a chunk of terms are a single sparse
+    # matrix product, divided by the norms of both sides afterwards. The query norm covers all of its bigrams, also
+    # those no term contains (the vectorizer drops them), which count with the idf of an unseen bigram. With
+    # weighting="binary" the similarity is the set based cosine (simstring differs only for strings with repeated
+    # bigrams, which it counts in the feature set sizes), with "tfidf" frequent bigrams (endings like "en", "er")
+    # count less.
+    # Almost every term shares some bigram with a query, so products are not sparse: like simstring, only terms with
+    # |q| * t^2 <= |bigrams| <= |q| / t^2 are candidates (exact for binary, a candidate filter for tfidf), terms are
+    # sorted by bigram count to make that a contiguous range, and products are thresholded chunk by chunk.
+    WEIGHTINGS = ("tfidf", "binary")
+
+    def __init__(self, terms: Iterable[str], threshold: float = 0.8, weighting: str = "tfidf",
+                 block_size: int = 256, term_chunk_size: int = 16384):
+        if weighting not in self.WEIGHTINGS:
+            raise UserWarning(f'Not supported weighting {weighting} (not one of {self.WEIGHTINGS})')
+        self.threshold = threshold
+        self.weighting = weighting
+        self.block_size = block_size
+        self.term_chunk_size = term_chunk_size
+        self.vectorizer = TfidfVectorizer(analyzer='char', ngram_range=(2, 2), lowercase=False, dtype=np.float32,
+                                          use_idf=weighting == "tfidf", binary=weighting == "binary", norm=None)
+        self.analyzer = self.vectorizer.build_analyzer()
+        terms = sorted(set(terms))
+        sizes = np.fromiter((self.bigram_count(term) for term in terms), dtype=np.int64, count=len(terms))
+        order = np.argsort(sizes, kind='stable')
+        self.terms = np.array(terms, dtype=object)[order]
+        self.term_sizes = sizes[order]
+        self.term_matrix = self.vectorizer.fit_transform(self.pad(self.terms)).tocsr()
+        self.term_norms = np.sqrt(np.asarray(self.term_matrix.multiply(self.term_matrix).sum(axis=1),
+                                             dtype=np.float64).ravel())
+        # smooth idf of a bigram with document frequency 0, i.e. the largest idf the vectorizer could assign
+        self.unseen_idf = float(np.log(1 + len(terms)) + 1)
+
+    @staticmethod
+    def pad(terms: Iterable[str]) -> List[str]:
+        return [f' {term} ' for term in terms]
+
+    def bigrams(self, term: str) -> List[str]:
+        return self.analyzer(f' {term} ')
+
+    def bigram_count(self, term: str) -> int:
+        return len(set(self.bigrams(term)))
+
+    def query_norm(self, query: str) -> float:
+        vocabulary = self.vectorizer.vocabulary_
+        squared = 0.0
+        for bigram, count in Counter(self.bigrams(query)).items():
+            weight = 1.0 if self.weighting == "binary" else float(count)
+            if self.weighting == "tfidf":
+                weight *= self.vectorizer.idf_[vocabulary[bigram]] if bigram in vocabulary else self.unseen_idf
+            squared += weight ** 2
+        return np.sqrt(squared)
+
+    def size_window(self, sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # small tolerance against float rounding at the borders
+        squared = self.threshold ** 2
+        return np.ceil(sizes * squared - 1e-9), np.floor(sizes / squared + 1e-9)
+
+    def unseen_bigram_queries(self, queries: Iterable[str], limit: int = 1000) -> List[str]:
+        # queries extended by a character no term contains: all bigrams with it are unseen, so an engine that ignored
+        # them in the query norm would over-score these against simstring
+        alphabet = set(chain.from_iterable(self.vectorizer.vocabulary_))
+        marker = next(chr(code) for code in range(0x2400, 0x2500) if chr(code) not in alphabet)
+        return [f'{query}{marker}' for query in islice(queries, limit)]
+
+    def search_all(self, queries: Iterable[str]) -> Dict[str, List[str]]:
+        queries = list(dict.fromkeys(queries))
+        sizes = np.fromiter((self.bigram_count(query) for query in queries), dtype=np.int64, count=len(queries))
+        norms = np.fromiter((self.query_norm(query) for query in queries), dtype=np.float64, count=len(queries))
+        # queries without bigrams match nothing
+        norms[norms == 0] = np.inf
+        # similar sized queries in one block keep its candidate range narrow
+        order = np.argsort(sizes, kind='stable')
+        results = {}
+        for start in tqdm(range(0, len(queries), self.block_size), desc="tfidf search",
+                          disable=len(queries) <= self.block_size):
+            block_rows = order[start:start + self.block_size]
+            block = [queries[i] for i in block_rows]
+            query_matrix = self.vectorizer.transform(self.pad(block))
+            block_norms = norms[block_rows]
+            lower, upper = self.size_window(sizes[block_rows])
+            first = np.searchsorted(self.term_sizes, lower.min(), side='left')
+            last = np.searchsorted(self.term_sizes, upper.max(), side='right')
+
+            rows, columns, scores = [], [], []
+            for chunk_start in range(first, last, self.term_chunk_size):
+                chunk_end = min(chunk_start + self.term_chunk_size, last)
+                products = (query_matrix @ self.term_matrix[chunk_start:chunk_end].T).tocoo()
+                chunk_columns = products.col + chunk_start
+                similarities = products.data / (block_norms[products.row] * self.term_norms[chunk_columns])
+                # small tolerance so exact matches are not lost to float32 rounding
+                keep = similarities >= self.threshold - 1e-6
+                rows.append(products.row[keep])
+                columns.append(chunk_columns[keep])
+                scores.append(similarities[keep])
+            rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+            columns = np.concatenate(columns) if columns else np.empty(0, dtype=np.int64)
+            scores = np.concatenate(scores) if scores else np.empty(0, dtype=np.float64)
+
+            # the window of every single query, so results do not depend on the block a query ended up in
+            term_sizes = self.term_sizes[columns]
+            in_window = (term_sizes >= lower[rows]) & (term_sizes <= upper[rows])
+            rows, columns, scores = rows[in_window], columns[in_window], scores[in_window]
+            ranking = np.lexsort((columns, -scores, rows))
+            rows, columns = rows[ranking], columns[ranking]
+            bounds = np.searchsorted(rows, np.arange(len(block) + 1))
+            for row, query in enumerate(block):
+                results[query] = self.terms[columns[bounds[row]:bounds[row + 1]]].tolist()
+        return results
+
+    def search(self, query: str) -> List[str]:
+        return self.search_all([query])[query]
+
+    @staticmethod
+    def agreement(reference: Dict[str, List[str]], candidate: Dict[str, List[str]],
+                  queries: Iterable[str]) -> Dict[str, float]:
+        # how well the candidate engine reproduces the reference engine on the same queries
+        queries = list(queries)
+        true_positives = reference_hits = candidate_hits = exact = top1 = 0
+        for query in queries:
+            reference_terms = set(reference.get(query, []))
+            candidate_terms = set(candidate.get(query, []))
+            true_positives += len(reference_terms & candidate_terms)
+            reference_hits += len(reference_terms)
+            candidate_hits += len(candidate_terms)
+            exact += reference_terms == candidate_terms
+            # standardization only uses the first hit
+            top1 += (not reference_terms and not candidate_terms) or \
+                    (bool(candidate_terms) and candidate[query][0] in reference_terms)
+        return {"queries": len(queries),
+                "precision": true_positives / candidate_hits if candidate_hits else 1.0,
+                "recall": true_positives / reference_hits if reference_hits else 1.0,
+                "exact_agreement": exact / len(queries) if queries else 1.0,
+                "top1_agreement": top1 / len(queries) if queries else 1.0}
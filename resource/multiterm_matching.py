@@ -0,0 +1,146 @@
+import re
+from array import array
+from bisect import bisect_left
+from collections import deque, Counter
+from typing import Iterable, List, Dict, Tuple
+from tqdm import tqdm
+
+TOKEN_PATTERN = re.compile(r"\w+(?:[-'.]\w+)*|[^\w\s]")
+
+
+class TokenAhoCorasick:
+    # Token level Aho-Corasick automaton over all terms of a replacement dict (e.g. UMLS term -> CUI). The trie is
+    # compiled into flat arrays: the sorted child tokens of every state are a slice of child_tokens (CSR layout, found
+    # by bisect), and failure links, output links and term outputs are one int per state, so millions of terms need
+    # a fraction of the memory of a PhraseMatcher holding one Doc per term.
+    def __init__(self, replacement_dict: Dict[str, str]):
+        self.token2id = {}
+        self.values = []
+        value2id = {}
+
+        children = [{}]
+        outputs = [-1]
+        depths = [0]
+        for term, value in tqdm(replacement_dict.items(), desc="Compile terms", total=len(replacement_dict)):
+            tokens = self.tokenize(term)
+            if not tokens:
+                continue
+            state = 0
+            for token in tokens:
+                token_id = self.token2id.setdefault(token, len(self.token2id))
+                next_state = children[state].get(token_id)
+                if next_state is None:
+                    next_state = len(children)
+                    children[state][token_id] = next_state
+                    children.append({})
+                    outputs.append(-1)
+                    depths.append(depths[state] + 1)
+                state = next_state
+            # like the dict itself, a term that tokenizes like an earlier one overwrites it
+            outputs[state] = value2id.setdefault(value, len(value2id))
+        self.values = list(value2id.keys())
+
+        fails = [0] * len(children)
+        output_links = [-1] * len(children)
+        queue = deque(children[0].values())
+        while queue:
+            state = queue.popleft()
+            for token_id, child in children[state].items():
+                fail = fails[state]
+                while fail and token_id not in children[fail]:
+                    fail = fails[fail]
+                fails[child] = children[fail].get(token_id, 0)
+                # nearest proper suffix state that ends a term
+                suffix = fails[child]
+                output_links[child] = suffix if outputs[suffix] != -1 else output_links[suffix]
+                queue.append(child)
+
+        self.child_indptr = array('l', [0])
+        self.child_tokens = array('i')
+        self.child_states = array('i')
+        for state_children in children:
+            for token_id in sorted(state_children):
+                self.child_tokens.append(token_id)
+                self.child_states.append(state_children[token_id])
+            self.child_indptr.append(len(self.child_tokens))
+        self.fails = array('i', fails)
+        self.output_links = array('i', output_links)
+        self.outputs = array('i', outputs)
+        self.depths = array('i', depths)
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return TOKEN_PATTERN.findall(text)
+
+    def child(self, state: int, token_id: int) -> int:
+        start, end = self.child_indptr[state], self.child_indptr[state + 1]
+        i = bisect_left(self.child_tokens, token_id, start, end)
+        if i < end and self.child_tokens[i] == token_id:
+            return self.child_states[i]
+        return -1
+
+    def find_matches(self, tokens: List[str]) -> List[Tuple[int, int, int]]:
+        # all (value id, start, end) token spans of terms in the sentence
+        matches = []
+        state = 0
+        for position, token in enumerate(tokens):
+            token_id = self.token2id.get(token)
+            if token_id is None:
+                state = 0
+                continue
+            next_state = self.child(state, token_id)
+            while next_state == -1 and state:
+                state = self.fails[state]
+                next_state = self.child(state, token_id)
+            state = max(next_state, 0)
+
+            output_state = state if self.outputs[state] != -1 else self.output_links[state]
+            while output_state > 0:
+                matches.append((self.outputs[output_state], position + 1 - self.depths[output_state], position + 1))
+                output_state = self.output_links[output_state]
+        return matches
+
+    def replace_tokens(self, tokens: List[str]) -> List[str]:
+        # leftmost-longest, non-overlapping replacement as for the spaCy path
+        spans = {}
+        for value_id, start, end in self.find_matches(tokens):
+            if end - start > spans.get(start, (0, -1))[0]:
+                spans[start] = (end - start, value_id)
+        replaced = []
+        position = 0
+        for start in sorted(spans):
+            if start < position:
+                continue
+            length, value_id = spans[start]
+            replaced.extend(tokens[position:start])
+            replaced.append(self.values[value_id])
+            position = start + length
+        replaced.extend(tokens[position:])
+        return replaced
+
+    def replace_documents(self, documents: Iterable[str], tokenize: bool = True) -> Iterable:
+        for document in documents:
+            replaced = self.replace_tokens(self.tokenize(document))
+            yield replaced if tokenize else ' '.join(replaced)
+
+    @staticmethod
+    def parity(reference: List[List[str]], candidate: List[List[str]], values: Iterable[str]) -> Dict[str, float]:
+        # compares the replaced values (e.g. CUIs) per document, tokenization differences of the engines aside
+        values = set(values)
+        identical = same_values = shared = reference_count = candidate_count = 0
+        for reference_tokens, candidate_tokens in zip(reference, candidate):
+            reference_values = [token for token in reference_tokens if token in values]
+            candidate_values = [token for token in candidate_tokens if token in values]
+            identical += reference_tokens == candidate_tokens
+            same_values += sorted(reference_values) == sorted(candidate_values)
+            shared += sum((Counter(reference_values) & Counter(candidate_values)).values())
+            reference_count += len(reference_values)
+            candidate_count += len(candidate_values)
+        documents = len(reference)
+        return {"documents": documents,
+                "identical_documents": identical / documents if documents else 1.0,
+                "identical_replacements": same_values / documents if documents else 1.0,
+                "reference_replacements": reference_count,
+                "candidate_replacements": candidate_count,
+                "precision": shared / candidate_count if candidate_count else 1.0,
+                "recall": shared / reference_count if reference_count else 1.0}
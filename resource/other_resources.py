@@ -1,26 +1,44 @@
 import json
 from abc import ABC, abstractmethod
 import os
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Iterable, Type
 from collections import defaultdict
 import pandas as pd
 
+from utils.resource_cache import ResourceCache
+from utils.shared_resources import SharedResources
+
 
 class Evaluator(ABC):
+    # files in the resource directory the evaluator is parsed from, their checksums invalidate the binary cache
+    source_files = []
+
     @abstractmethod
     def load_semantics(self, directory: str):
         raise NotImplementedError
 
-    def check_for_json_and_parse(self, from_dir: str, json_path: str):
+    def check_for_json_and_parse(self, from_dir: str, json_path: str, shared: bool = False):
         if from_dir:
             json_path = os.path.join(from_dir, json_path)
-            if os.path.exists(json_path):
-                print(f"initialize {self.__class__.__name__}... Load cached json of {from_dir}")
-                self.set_attributes(*self.load_from_json(json_path))
-            else:
-                print(f"initialize {self.__class__.__name__}... Load dir {from_dir}")
-                self.set_attributes(*self.load_semantics(from_dir))
-                self.save_as_json(path=json_path)
+            shared_dir = SharedResources.shared_dir(json_path)
+            if shared and SharedResources.is_current(shared_dir, json_path, from_dir, self.source_files):
+                print(f"initialize {self.__class__.__name__}... Attach shared resources of {from_dir}")
+                self.set_attributes(*SharedResources.attach(shared_dir))
+                return
+            data = self.load_cached_or_parse(from_dir, json_path)
+            if shared:
+                data = SharedResources.publish(shared_dir, data, json_path, from_dir, self.source_files)
+            self.set_attributes(*data)
+
+    def load_cached_or_parse(self, from_dir: str, json_path: str) -> tuple:
+        def save_json(path: str, data: tuple):
+            self.set_attributes(*data)
+            self.save_as_json(path=path)
+
+        return ResourceCache.load_or_parse(self.__class__.__name__, from_dir, json_path, self.source_files,
+                                           parse=self.load_semantics, load_json=self.load_from_json,
+                                           save_json=save_json)
 
     def save_as_json(self, path: str):
         data = self.__dict__
@@ -37,12 +55,14 @@ class Evaluator(ABC):
 
 
 class NDFEvaluator(Evaluator):
+    source_files = ["may_treat_cui.txt", "may_prevent_cui.txt"]
+
     def set_attributes(self, *args):
         self.may_treat, self.may_prevent, self.reverted_treat, self.reverted_prevent = args
 
-    def __init__(self, from_dir: str = None, json_path: str = "ndf_eval.json"):
+    def __init__(self, from_dir: str = None, json_path: str = "ndf_eval.json", shared: bool = False):
         self.may_treat, self.may_prevent, self.reverted_treat, self.reverted_prevent = None, None, None, None
-        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path)
+        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path, shared=shared)
 
     def load_semantics(self, directory: str):
         def load_file(file_name: str) -> Dict[str, List[str]]:
@@ -79,12 +99,14 @@ class NDFEvaluator(Evaluator):
 
 
 class SRSEvaluator(Evaluator):
+    source_files = ["UMNSRS_similarity.csv", "UMNSRS_relatedness.csv", "MayoSRS.csv"]
+
     def set_attributes(self, *args):
         self.human_similarity_cont, self.human_relatedness_cont, self.human_relatedness_mayo_srs = args
 
-    def __init__(self, from_dir: str = None, json_path: str = "srs_eval.json"):
+    def __init__(self, from_dir: str = None, json_path: str = "srs_eval.json", shared: bool = False):
         self.human_similarity_cont, self.human_relatedness_cont, self.human_relatedness_mayo_srs = None, None, None
-        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path)
+        self.check_for_json_and_parse(from_dir=from_dir, json_path=json_path, shared=shared)
 
     def load_semantics(self, directory: str):
         def load_file(file_name: str) -> pd.DataFrame:
@@ -113,3 +135,39 @@ class SRSEvaluator(Evaluator):
         with open(path, 'r', encoding='utf-8') as file:
             data = json.loads(file.read())
         return data["human_similarity_cont"], data["human_relatedness_cont"], data['human_relatedness_mayo_srs']
+
+
+class EvaluatorRegistry:
+    # evaluators are registered with their constructor arguments and only built (and their resources parsed) when a
+    # benchmark requires them for the first time; several missing evaluators are loaded in parallel threads
+    def __init__(self):
+        self.arguments = {}
+        self.evaluators = {}
+
+    def register(self, evaluator_class: Type[Evaluator], **kwargs) -> "EvaluatorRegistry":
+        self.arguments[evaluator_class] = kwargs
+        return self
+
+    def build(self, evaluator_class: Type[Evaluator]) -> Evaluator:
+        return evaluator_class(**self.arguments[evaluator_class])
+
+    def require(self, evaluator_classes: Iterable[Type[Evaluator]]) -> List[Evaluator]:
+        evaluator_classes = list(dict.fromkeys(evaluator_classes))
+        unregistered = [evaluator_class.__name__ for evaluator_class in evaluator_classes
+                        if evaluator_class not in self.arguments]
+        if unregistered:
+            print(f"No evaluator registered for {', '.join(unregistered)}")
+        missing = [evaluator_class for evaluator_class in evaluator_classes
+                   if evaluator_class in self.arguments and evaluator_class not in self.evaluators]
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                for evaluator_class, evaluator in zip(missing, executor.map(self.build, missing)):
+                    self.evaluators[evaluator_class] = evaluator
+        elif missing:
+            self.evaluators[missing[0]] = self.build(missing[0])
+        return [self.evaluators[evaluator_class] for evaluator_class in evaluator_classes
+                if evaluator_class in self.evaluators]
+
+    def get(self, evaluator_class: Type[Evaluator]) -> Evaluator:
+        evaluators = self.require([evaluator_class])
+        return evaluators[0] if evaluators else None
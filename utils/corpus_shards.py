@@ -0,0 +1,84 @@
+import json
+import os
+from itertools import chain, islice
+from typing import Iterable, List, Union
+
+
+class ShardedCorpus:
+    # Preprocessed documents as numbered json lines shards. The corpus is a restartable iterable, so gensim can run
+    # several passes over it without the documents ever being held in memory at once.
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, self.INDEX_FILE), encoding='utf-8') as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.lengths = index["lengths"]
+
+    @staticmethod
+    def shard_name(number: int) -> str:
+        return f'shard_{number:05d}.jsonl'
+
+    @classmethod
+    def is_complete(cls, directory: str) -> bool:
+        # the index is written last, a directory without it is a partial (e.g. interrupted) run
+        return os.path.exists(os.path.join(directory, cls.INDEX_FILE))
+
+    @classmethod
+    def write(cls, documents: Iterable[Union[List[str], str]], directory: str,
+              shard_size: int = 100000) -> "ShardedCorpus":
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, cls.INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        for file in os.listdir(directory):
+            if file.startswith('shard_') and file.endswith('.jsonl'):
+                os.remove(os.path.join(directory, file))
+
+        shards, lengths = [], []
+        documents = iter(documents)
+        while True:
+            shard = list(islice(documents, shard_size))
+            if not shard:
+                break
+            name = cls.shard_name(len(shards))
+            with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+                for document in shard:
+                    f.write(json.dumps(document, ensure_ascii=False))
+                    f.write('\n')
+            shards.append(name)
+            lengths.append(len(shard))
+
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump({"shards": shards, "lengths": lengths}, f)
+        return cls(directory)
+
+    def __iter__(self):
+        for name in self.shards:
+            with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def __len__(self) -> int:
+        return sum(self.lengths)
+
+    def head(self, n: int = 10) -> List[Union[List[str], str]]:
+        return list(islice(iter(self), n))
+
+
+class ConcatenatedCorpus:
+    # several (sharded) corpora iterated one after another, optionally cut after limit documents
+    def __init__(self, corpora: List[Iterable], limit: int = None):
+        self.corpora = corpora
+        self.limit = limit
+
+    def __iter__(self):
+        return islice(chain.from_iterable(self.corpora), self.limit)
+
+    def __len__(self) -> int:
+        length = sum(len(corpus) for corpus in self.corpora)
+        return length if self.limit is None else min(length, self.limit)
+
+    def head(self, n: int = 10) -> List[Union[List[str], str]]:
+        return list(islice(iter(self), n))
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Callable, Dict, Union
+
+
+class FileCache:
+    # meta files live next to the cached artifact, e.g. "embedding.txt.npy" -> "embedding.txt.npy.meta.json"
+    META_SUFFIX = ".meta.json"
+    # default place of the file hash memo, outside of the (possibly read-only) resource directories
+    MEMO_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aml4dh")
+
+    @staticmethod
+    def hash_file(path: str, chunk_size: int = 1 << 22) -> str:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    @staticmethod
+    def memoized_hash(path: str, memo_dir: str = None) -> str:
+        # content hash of a (large) file, only recomputed if its size or mtime changed since the last call; the memo
+        # is a best effort, an unreadable or unwritable memo only costs the hashing
+        memo_path = os.path.join(memo_dir or FileCache.MEMO_DIR, "file_hashes.json")
+        memo = {}
+        try:
+            if os.path.exists(memo_path):
+                with open(memo_path, encoding='utf-8') as f:
+                    memo = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"ignore file hash memo {memo_path}: {e}")
+        stat = FileCache.stat_fingerprint(path)
+        entry = memo.get(os.path.abspath(path))
+        if entry is not None and entry["size"] == stat["size"] and entry["mtime_ns"] == stat["mtime_ns"]:
+            return entry["md5"]
+        entry = dict(stat, md5=FileCache.hash_file(path))
+        memo[os.path.abspath(path)] = entry
+        try:
+            # written to a temporary file and swapped in, so concurrent readers never see a truncated memo
+            os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(memo_path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(memo, f)
+                os.replace(tmp_path, memo_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        except OSError as e:
+            print(f"could not update file hash memo {memo_path}: {e}")
+        return entry["md5"]
+
+    @staticmethod
+    def hash_strings(*values) -> str:
+        md5 = hashlib.md5()
+        for value in values:
+            md5.update(str(value).encode('utf-8'))
+            md5.update(b'\0')
+        return md5.hexdigest()
+
+    @staticmethod
+    def stat_fingerprint(path: str) -> Dict[str, int]:
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    @staticmethod
+    def fingerprint(path: str) -> str:
+        stat = FileCache.stat_fingerprint(path)
+        return f'{stat["size"]}-{stat["mtime_ns"]}'
+
+    @staticmethod
+    def meta_path(cache_path: str) -> str:
+        return f'{cache_path}{FileCache.META_SUFFIX}'
+
+    @staticmethod
+    def write_meta(cache_path: str, source_path: str, **extra: Union[str, int]):
+        meta = {"source": os.path.abspath(source_path), "md5": FileCache.hash_file(source_path)}
+        meta.update(FileCache.stat_fingerprint(source_path))
+        meta.update(extra)
+        with open(FileCache.meta_path(cache_path), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def write(cache_path: str, source_path: str, writer: Callable[[str], None], **extra: Union[str, int]) -> bool:
+        # the stale meta is removed first, so an interrupted write never leaves a cache that looks valid
+        try:
+            if os.path.exists(FileCache.meta_path(cache_path)):
+                os.remove(FileCache.meta_path(cache_path))
+            writer(cache_path)
+            FileCache.write_meta(cache_path, source_path, **extra)
+            return True
+        except OSError as e:
+            print(f"could not write cache {cache_path} of {source_path}: {e}")
+            return False
+
+    @staticmethod
+    def is_valid(cache_path: str, source_path: str, **extra: Union[str, int]) -> bool:
+        # size and mtime decide in the common case, the content hash is only computed when the mtime changed
+        # (e.g. after copying the data to another drive) to avoid rebuilding an identical cache
+        meta_path = FileCache.meta_path(cache_path)
+        if not (os.path.exists(cache_path) and os.path.exists(meta_path) and os.path.exists(source_path)):
+            return False
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if any(meta.get(key) != value for key, value in extra.items()):
+            return False
+        stat = FileCache.stat_fingerprint(source_path)
+        if meta.get("size") != stat["size"]:
+            return False
+        if meta.get("mtime_ns") == stat["mtime_ns"]:
+            return True
+        if meta.get("md5") != FileCache.hash_file(source_path):
+            return False
+        meta.update(stat)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        return True
@@ -0,0 +1,106 @@
+import os
+import pickle
+import sys
+from typing import Any, Callable, Dict, List, Union
+
+from utils.file_cache import FileCache
+
+
+class ResourceCache:
+    # Binary companion of the parsed resource json files (mapper.json, umls_eval.json, ...). The payload is pickled
+    # with interned strings, so repeated CUIs and terms are stored and loaded once, and it records the version of
+    # this format, the checksums of the source files it was parsed from and the fingerprint of the json it mirrors.
+    # Changed sources (e.g. a new UMLS release) make callers parse the sources again, a changed json makes them fall
+    # back to the json.
+    VERSION = 1
+    SUFFIX = ".pkl"
+
+    @staticmethod
+    def cache_path(json_path: str) -> str:
+        return f'{os.path.splitext(json_path)[0]}{ResourceCache.SUFFIX}'
+
+    @staticmethod
+    def compact(data: Any) -> Any:
+        # plain dicts and lists (no defaultdict factories) with interned strings
+        if isinstance(data, str):
+            return sys.intern(data)
+        if isinstance(data, dict):
+            return {ResourceCache.compact(key): ResourceCache.compact(value) for key, value in data.items()}
+        if isinstance(data, (list, tuple)):
+            return type(data)(ResourceCache.compact(value) for value in data)
+        return data
+
+    @staticmethod
+    def source_checksums(directory: str, source_files: List[str]) -> Dict[str, str]:
+        # sources that are missing or cannot be read are left out, like in the original json only setup
+        checksums = {}
+        for file in source_files:
+            path = os.path.join(directory, file)
+            if os.path.exists(path):
+                try:
+                    checksums[file] = FileCache.memoized_hash(path)
+                except OSError as e:
+                    print(f"could not hash source {path}: {e}")
+        return checksums
+
+    @staticmethod
+    def save(json_path: str, data: tuple, directory: str, source_files: List[str]):
+        try:
+            payload = {"version": ResourceCache.VERSION,
+                       "sources": ResourceCache.source_checksums(directory, source_files),
+                       "json": FileCache.stat_fingerprint(json_path),
+                       "data": ResourceCache.compact(data)}
+            with open(ResourceCache.cache_path(json_path), 'wb') as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except (OSError, pickle.PicklingError) as e:
+            print(f"could not write binary cache of {json_path}: {e}")
+
+    @staticmethod
+    def read(json_path: str) -> Union[Dict[str, Any], None]:
+        path = ResourceCache.cache_path(json_path)
+        if not (os.path.exists(path) and os.path.exists(json_path)):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                payload = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"could not read binary cache {path}: {e}")
+            return None
+        if payload.get("version") != ResourceCache.VERSION:
+            return None
+        return payload
+
+    @staticmethod
+    def sources_changed(payload: Dict[str, Any], directory: str, source_files: List[str]) -> bool:
+        # sources that are not present (anymore) do not count as changed
+        checksums = ResourceCache.source_checksums(directory, source_files)
+        return any(payload["sources"].get(file) != checksum for file, checksum in checksums.items())
+
+    @staticmethod
+    def matches_json(payload: Dict[str, Any], json_path: str) -> bool:
+        return payload["json"] == FileCache.stat_fingerprint(json_path)
+
+    @staticmethod
+    def load_or_parse(name: str, from_dir: str, json_path: str, source_files: List[str],
+                      parse: Callable[[str], tuple], load_json: Callable[[str], tuple],
+                      save_json: Callable[[str, tuple], None]) -> tuple:
+        # binary cache if it is current, else the json, else the sources (which also rewrite the json)
+        payload = ResourceCache.read(json_path)
+        if payload is not None and ResourceCache.sources_changed(payload, from_dir, source_files):
+            print(f"sources of {json_path} changed")
+            payload, json_exists = None, False
+        else:
+            json_exists = os.path.exists(json_path)
+
+        if payload is not None and ResourceCache.matches_json(payload, json_path):
+            print(f"initialize {name}... Load binary cache of {from_dir}")
+            return payload["data"]
+        if json_exists:
+            print(f"initialize {name}... Load cached json of {from_dir}")
+            data = load_json(json_path)
+        else:
+            print(f"initialize {name}... Load dir {from_dir}")
+            data = parse(from_dir)
+            save_json(json_path, data)
+        ResourceCache.save(json_path, data, from_dir, source_files)
+        return data
@@ -0,0 +1,217 @@
+import json
+import os
+from bisect import bisect_left
+from collections.abc import ItemsView, Mapping, Sequence, ValuesView
+from itertools import chain
+from typing import Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+
+from utils.file_cache import FileCache
+from utils.resource_cache import ResourceCache
+
+
+class StringTable(Sequence):
+    # sorted unique strings as one utf-8 byte buffer plus offsets, an item is only decoded when it is accessed, so the
+    # table costs about the size of its text and can be memory mapped (utf-8 byte order equals str order for bisect)
+    def __init__(self, buffer: np.ndarray, offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings: Iterable[str]) -> "StringTable":
+        encoded = [string.encode('utf-8') for string in sorted(set(strings))]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.fromiter((len(string) for string in encoded), dtype=np.int64, count=len(encoded)))
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def find(self, string: str) -> int:
+        # position of the string or -1
+        i = bisect_left(self, string)
+        return i if i < len(self) and self[i] == string else -1
+
+
+class ArrayItemsView(ItemsView):
+    def __iter__(self):
+        for row in range(len(self._mapping)):
+            yield self._mapping.key_table[row], self._mapping.value_at(row)
+
+
+class ArrayValuesView(ValuesView):
+    def __iter__(self):
+        for row in range(len(self._mapping)):
+            yield self._mapping.value_at(row)
+
+
+class ArrayMapping(Mapping):
+    # Read-only replacement of the resource dicts (str -> str, str -> list of str or str -> dict of str -> float).
+    # Keys are a sorted StringTable, every distinct value string exists once in a second table and the values of a
+    # key are an int32 id slice of it (CSR layout), so a lookup is a binary search instead of a hash, but no Python
+    # object exists per entry until it is accessed.
+    KINDS = ("str", "list", "dict")
+
+    def __init__(self, key_table: StringTable, value_table: StringTable, indptr: np.ndarray, value_ids: np.ndarray,
+                 weights: np.ndarray = None, kind: str = "list", location: Tuple[str, int] = None):
+        if kind not in self.KINDS:
+            raise UserWarning(f'Not supported kind {kind} (not one of {self.KINDS})')
+        self.key_table = key_table
+        self.value_table = value_table
+        self.indptr = indptr
+        self.value_ids = value_ids
+        self.weights = weights
+        self.kind = kind
+        # (directory, position) of published mappings, pickled instead of the arrays
+        self.location = location
+
+    @classmethod
+    def from_dict(cls, dictionary: Mapping) -> "ArrayMapping":
+        first = next(iter(dictionary.values()), [])
+        kind = "str" if isinstance(first, str) else "dict" if isinstance(first, Mapping) else "list"
+        key_table = StringTable.from_strings(dictionary.keys())
+        rows = [dictionary[key] for key in key_table]
+        if kind == "str":
+            rows = [[value] for value in rows]
+        value_strings = sorted(set(chain.from_iterable(rows)))
+        value2id = {value: i for i, value in enumerate(value_strings)}
+
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows)))
+        value_ids = np.fromiter((value2id[value] for row in rows for value in row), dtype=np.int32,
+                                count=int(indptr[-1]))
+        weights = None
+        if kind == "dict":
+            weights = np.fromiter((weight for row in rows for weight in row.values()), dtype=np.float64,
+                                  count=int(indptr[-1]))
+        return cls(key_table, StringTable.from_strings(value_strings), indptr, value_ids, weights, kind)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {"key_buffer": self.key_table.buffer, "key_offsets": self.key_table.offsets,
+                  "value_buffer": self.value_table.buffer, "value_offsets": self.value_table.offsets,
+                  "indptr": self.indptr, "value_ids": self.value_ids}
+        if self.weights is not None:
+            arrays["weights"] = self.weights
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], kind: str, location: Tuple[str, int] = None) -> "ArrayMapping":
+        return cls(StringTable(arrays["key_buffer"], arrays["key_offsets"]),
+                   StringTable(arrays["value_buffer"], arrays["value_offsets"]),
+                   arrays["indptr"], arrays["value_ids"], arrays.get("weights"), kind, location)
+
+    def value_at(self, row: int) -> Union[str, List[str], Dict[str, float]]:
+        start, end = self.indptr[row], self.indptr[row + 1]
+        if self.kind == "str":
+            return self.value_table[int(self.value_ids[start])]
+        values = [self.value_table[i] for i in self.value_ids[start:end].tolist()]
+        if self.kind == "list":
+            return values
+        return dict(zip(values, self.weights[start:end].tolist()))
+
+    def __getitem__(self, key: str):
+        row = self.key_table.find(key) if isinstance(key, str) else -1
+        if row < 0:
+            raise KeyError(key)
+        return self.value_at(row)
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self.key_table.find(key) >= 0
+
+    def __iter__(self):
+        return iter(self.key_table)
+
+    def __len__(self) -> int:
+        return len(self.key_table)
+
+    def items(self) -> ArrayItemsView:
+        # row wise, without a binary search per key
+        return ArrayItemsView(self)
+
+    def values(self) -> ArrayValuesView:
+        return ArrayValuesView(self)
+
+    def __reduce__(self):
+        # a published mapping is sent to other processes as its location, they attach to the same files
+        if self.location is not None:
+            return SharedResources.attach_mapping, self.location
+        return super().__reduce__()
+
+
+class SharedResources:
+    # Publishes the dicts of a parsed resource (the data tuple of UMLSMapper or of an Evaluator) as ArrayMappings in
+    # .npy files which every process memory maps read-only. The pages are shared by the OS page cache, so workers
+    # attach without deserializing anything and memory per worker stays flat as the number of workers grows.
+    VERSION = 1
+    MANIFEST_FILE = "manifest.json"
+
+    @staticmethod
+    def shared_dir(json_path: str) -> str:
+        return f'{os.path.splitext(json_path)[0]}_shared'
+
+    @staticmethod
+    def read_manifest(directory: str) -> Union[Dict, None]:
+        manifest_path = os.path.join(directory, SharedResources.MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        return manifest if manifest.get("version") == SharedResources.VERSION else None
+
+    @staticmethod
+    def is_current(directory: str, json_path: str, source_dir: str, source_files: List[str]) -> bool:
+        manifest = SharedResources.read_manifest(directory)
+        return manifest is not None and os.path.exists(json_path) \
+            and manifest["json"] == FileCache.stat_fingerprint(json_path) \
+            and not ResourceCache.sources_changed(manifest, source_dir, source_files)
+
+    @staticmethod
+    def publish(directory: str, data: tuple, json_path: str, source_dir: str,
+                source_files: List[str]) -> Tuple[Mapping, ...]:
+        # returns the attached mappings, or the given dicts if the directory is not writable
+        manifest_path = os.path.join(directory, SharedResources.MANIFEST_FILE)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # the manifest is written last, a directory without it is incomplete
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            kinds = []
+            for position, dictionary in enumerate(data):
+                mapping = ArrayMapping.from_dict(dictionary)
+                for name, array in mapping.arrays().items():
+                    np.save(os.path.join(directory, f'{position}_{name}.npy'), array)
+                kinds.append(mapping.kind)
+            manifest = {"version": SharedResources.VERSION, "kinds": kinds,
+                        "json": FileCache.stat_fingerprint(json_path),
+                        "sources": ResourceCache.source_checksums(source_dir, source_files)}
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+        except OSError as e:
+            print(f"could not publish shared resources to {directory}: {e}")
+            return data
+        return SharedResources.attach(directory)
+
+    @staticmethod
+    def attach_mapping(directory: str, position: int) -> ArrayMapping:
+        kind = SharedResources.read_manifest(directory)["kinds"][position]
+        arrays = {}
+        for name in ("key_buffer", "key_offsets", "value_buffer", "value_offsets", "indptr", "value_ids", "weights"):
+            path = os.path.join(directory, f'{position}_{name}.npy')
+            if os.path.exists(path):
+                arrays[name] = np.load(path, mmap_mode='r')
+        return ArrayMapping.from_arrays(arrays, kind, location=(directory, position))
+
+    @staticmethod
+    def attach(directory: str) -> Tuple[ArrayMapping, ...]:
+        manifest = SharedResources.read_manifest(directory)
+        return tuple(SharedResources.attach_mapping(directory, position) for position in range(len(manifest["kinds"])))
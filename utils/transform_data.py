@@ -1,13 +1,18 @@
 import json
 import os
 from collections import defaultdict, Counter
-from typing import List, Dict
+from typing import List, Dict, Iterable, Tuple
 
+import numpy as np
 import spacy
 from spacy.matcher.phrasematcher import PhraseMatcher
+from spacy.tokens import DocBin
 from tqdm import tqdm
 import pandas as pd
 
+from utils.file_cache import FileCache
+from utils.w2v_format import Word2VecFormat
+
 
 class ConfigLoader:
     @staticmethod
@@ -29,6 +34,25 @@ class ConfigLoader:
         raise Exception("config file missing!")
 
 
+class SpacyModels:
+    # process wide registry of loaded pipelines, keyed by model name, disabled components and added pipes; forked
+    # worker processes inherit the loaded models copy-on-write instead of loading them again
+    models = {}
+    TOKENIZER_ONLY = ("tagger", "parser", "ner")
+
+    @classmethod
+    def get(cls, name: str = "de_core_news_sm", disable: Iterable[str] = (), pipes: Iterable[str] = ()):
+        key = (name, tuple(sorted(disable)), tuple(pipes))
+        nlp = cls.models.get(key)
+        if nlp is None:
+            print(f"load spaCy model {name}...")
+            nlp = spacy.load(name, disable=list(disable))
+            for pipe in pipes:
+                nlp.add_pipe(nlp.create_pipe(pipe))
+            cls.models[key] = nlp
+        return nlp
+
+
 class DataHandler:
     @staticmethod
     def path_exists(path: str) -> bool:
@@ -41,6 +65,12 @@ class DataHandler:
 
         return data.split("\n")
 
+    @staticmethod
+    def iter_lines(path: str, encoding="utf-8") -> Iterable[str]:
+        with open(path, encoding=encoding) as f:
+            for line in f:
+                yield line.rstrip("\n")
+
     @staticmethod
     def concat_path_sentences(paths: List[str]) -> List[str]:
         sentences = []
@@ -66,9 +96,7 @@ class DataHandler:
 
     @staticmethod
     def sentenize(document_text):
-        german_model = spacy.load("de_core_news_sm")
-        sbd = german_model.create_pipe('sentencizer')
-        german_model.add_pipe(sbd)
+        german_model = SpacyModels.get("de_core_news_sm", pipes=("sentencizer",))
 
         doc = german_model(document_text)
 
@@ -106,36 +134,73 @@ class DataHandler:
         DataHandler.save(new_path, "\n".join(lines))
 
     @staticmethod
-    def replace_documents_with_spacy(documents: List[str], replacement_dict: Dict[str, str]) -> List[str]:
-        nlp = spacy.load('de_core_news_sm')
+    def tokenized_docs(nlp, documents: Iterable[str], n_process: int = 1, batch_size: int = 1000) -> Iterable:
+        # only the tokenizer is needed for matching and tokenization, it runs without the other pipeline components
+        # and, with n_process > 1, in worker processes that return the docs in input order
+        if n_process > 1:
+            return nlp.pipe(documents, disable=nlp.pipe_names, n_process=n_process, batch_size=batch_size)
+        return nlp.tokenizer.pipe(documents, batch_size=batch_size)
+
+    @staticmethod
+    def phrase_matcher(nlp, terms: Iterable[str], cache_path: str = None, source_path: str = None) -> PhraseMatcher:
+        # tokenizing all terms into pattern docs is the expensive part of the matcher, so the patterns are persisted
+        # as DocBin keyed by the file the terms come from and the spaCy model
+        model = f'{nlp.meta.get("lang")}_{nlp.meta.get("name")}-{nlp.meta.get("version")}'
+        use_cache = cache_path is not None and source_path is not None
+        if use_cache and FileCache.is_valid(cache_path, source_path, model=model):
+            print(f"load phrase matcher patterns {cache_path}...")
+            with open(cache_path, 'rb') as f:
+                patterns = list(DocBin().from_bytes(f.read()).get_docs(nlp.vocab))
+        else:
+            # Only run nlp.make_doc to speed things up
+            patterns = [nlp.make_doc(term) for term in terms]
+            if use_cache:
+                doc_bin = DocBin(attrs=["ORTH"], docs=patterns)
+
+                def writer(path: str):
+                    with open(path, 'wb') as f:
+                        f.write(doc_bin.to_bytes())
+
+                FileCache.write(cache_path, source_path, writer, model=model)
         matcher = PhraseMatcher(nlp.vocab)
-        terms = replacement_dict.keys()
-        doc_pipe = list(nlp.pipe(documents, disable=["tagger", "parser", "ner"]))
-        # Only run nlp.make_doc to speed things up
-        patterns = [nlp.make_doc(term) for term in terms]
         matcher.add("TerminologyList", None, *patterns)
-        replaced_docs = []
-        replaced_cuis = []
-        for doc in tqdm(doc_pipe, desc="Replace with concepts", total=len(documents)):
-            text_doc = doc.text
-            matches = matcher(doc)
-            concepts = []
-            for match_id, start, end in matches:
-                span = doc[start:end]
-                concepts.append(span.text)
-
-            concepts.sort(key=lambda s: len(s), reverse=True)
-            for concept in concepts:
-                if True or concept in replacement_dict:
-                    text_doc = text_doc.replace(concept, replacement_dict[concept])
-                    replaced_cuis.append(replacement_dict[concept])
-
-            replaced_docs.append(text_doc)
-
-            # tokens = [token for token in text_doc.split()]
-            # replaced_docs.append(tokens)
-        # print(len(replaced_cuis), len(set(replaced_cuis)), replaced_cuis[:3])
-        return replaced_docs
+        return matcher
+
+    @staticmethod
+    def replace_documents_with_spacy(documents: List[str], replacement_dict: Dict[str, str],
+                                     matcher_cache_path: str = None, source_path: str = None) -> List[str]:
+        nlp = SpacyModels.get('de_core_news_sm', disable=SpacyModels.TOKENIZER_ONLY)
+        doc_pipe = list(nlp.pipe(documents))
+        matcher = DataHandler.phrase_matcher(nlp, replacement_dict.keys(), cache_path=matcher_cache_path,
+                                             source_path=source_path)
+        return [DataHandler.replace_matches(doc, matcher(doc), replacement_dict)
+                for doc in tqdm(doc_pipe, desc="Replace with concepts", total=len(documents))]
+
+    @staticmethod
+    def longest_matches(matches: List[Tuple[int, int, int]]) -> List[Tuple[int, int]]:
+        # leftmost-longest, non-overlapping token spans
+        spans = []
+        last_end = 0
+        for start, end in sorted(((start, end) for _, start, end in matches), key=lambda span: (span[0], -span[1])):
+            if start >= last_end:
+                spans.append((start, end))
+                last_end = end
+        return spans
+
+    @staticmethod
+    def replace_matches(doc, matches: List[Tuple[int, int, int]], replacement_dict: Dict[str, str]) -> str:
+        # the sentence is rebuilt once from the character offsets of the matches instead of replacing each matched
+        # string in the whole text, which also hit overlapping matches and already inserted replacements
+        matches = [(match_id, start, end) for match_id, start, end in matches if doc[start:end].text in replacement_dict]
+        pieces = []
+        position = 0
+        for start, end in DataHandler.longest_matches(matches):
+            span = doc[start:end]
+            pieces.append(doc.text[position:span.start_char])
+            pieces.append(replacement_dict[span.text])
+            position = span.end_char
+        pieces.append(doc.text[position:])
+        return ''.join(pieces)
 
     @staticmethod
     def preprocess(tokens: List[str] = None, documents: List[List[str]] = None, lemmatize: bool = False,
@@ -147,7 +212,7 @@ class DataHandler:
                 representation = representation.lower()
             return representation
 
-        nlp = spacy.load("de_core_news_sm") if lan_model is None else lan_model
+        nlp = SpacyModels.get("de_core_news_sm") if lan_model is None else lan_model
         nlp.Defaults.stop_words |= {"der", "die", "das", "Der", "Die", "Das", "bei", "Bei", "In", "in"}
 
         if tokens:
@@ -223,7 +288,9 @@ class DataHandler:
         # print(len(replacements.keys()))
         # replaced_sentences = [replace(sentence, replacements) for sentence in tqdm(sentences)]
 
-        replaced_sentences = DataHandler.replace_documents_with_spacy(sentences, replacements)
+        replaced_sentences = DataHandler.replace_documents_with_spacy(sentences, replacements,
+                                                                      matcher_cache_path=f'{offset_path}.matcher',
+                                                                      source_path=offset_path)
         DataHandler.save(new_path, "\n".join(replaced_sentences))
 
     @staticmethod
@@ -252,7 +319,9 @@ class DataHandler:
         replacements = {str(k): str(most_common(vs)) for k, vs in replacements.items()}
         # replaced_sentences = [replace(sentence, replacements) for sentence in tqdm(sentences)]
 
-        replaced_sentences = DataHandler.replace_documents_with_spacy(sentences, replacements)
+        replaced_sentences = DataHandler.replace_documents_with_spacy(sentences, replacements,
+                                                                      matcher_cache_path=f'{offset_path}.matcher',
+                                                                      source_path=offset_path)
         DataHandler.save(new_path, "\n".join(replaced_sentences))
 
 
@@ -266,36 +335,17 @@ def replace_stanford_embeddings(emb_path: str, repl_path: str, new_path: str):
         else:
             print(splitted)
 
-    emb_lines = DataHandler.lines_from_file(emb_path)
-    new_lines = []
-    for line in emb_lines:
-        splitted = line.split()
-        if len(splitted) == 301:
-            if splitted[0] in look_up:
-                repl = look_up[splitted[0]]
-            else:
-                repl = splitted[0]
-            print(repl)
-            new_line = f'{repl} {" ".join(splitted[1:])}'
-        else:
-            new_line = line
-
-        new_lines.append(new_line)
-
-    DataHandler.save(new_path, "\n".join(new_lines))
+    words, vectors = Word2VecFormat.parse_text_parallel(emb_path)
+    words = [look_up.get(word, word) for word in words]
+    Word2VecFormat.write_text(new_path, words, vectors)
 
 
 def reformat_cui2vec(emb_path: str, new_path: str):
-    df = pd.read_csv(emb_path)
-    df.rename(columns={'Unnamed: 0': 'CUI'}, inplace=True)
-    lines = [f'{len(df.index)} {len(df.columns)-1}']
-    for i, row in tqdm(df.iterrows(), total=len(df.index)):
-        row_list = [str(value) for value in row.values]
-        lines.append(f'{row["CUI"]} {" ".join(row_list[1:])}')
-    lines.append('')
-    print(lines[:2])
-
-    DataHandler.save(new_path, "\n".join(lines))
+    df = pd.read_csv(emb_path, index_col=0)
+    df = df.astype(np.float32)
+    print(df.iloc[:2])
+
+    Word2VecFormat.write_text(new_path, [str(cui) for cui in df.index], df.to_numpy())
 
 # DataHandler.julielab_replacements(file_path='E:\AML4DH-DATA\CPG-AMIA2020\Plain Text\cpg-sentences.txt',
 #                                   offset_path='E:\AML4DH-DATA\offsets\cpg_offsets.tsv',
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+from typing import Iterable, List, Set, Tuple, BinaryIO
+import numpy as np
+from numpy import float32 as real
+
+
+def _parse_text_chunk(task: Tuple[str, int, int, str]) -> Tuple[List[str], np.ndarray]:
+    path, start, end, unicode_errors = task
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+    words = []
+    weights = []
+    for line in lines:
+        word, _, line_weights = line.rstrip().partition(b' ')
+        if not word:
+            continue
+        words.append(Word2VecFormat.decode(word, unicode_errors))
+        weights.append(line_weights)
+    # one NumPy call per block instead of one per line
+    return words, np.fromstring(b' '.join(weights), dtype=real, sep=' ')
+
+
+class Word2VecFormat:
+    @staticmethod
+    def read_header(f: BinaryIO) -> Tuple[int, int]:
+        vocab_size, vector_size = (int(x) for x in f.readline().split())
+        return vocab_size, vector_size
+
+    @staticmethod
+    def decode(word: bytes, unicode_errors: str = 'replace') -> str:
+        return word.decode('utf-8', errors=unicode_errors)
+
+    @staticmethod
+    def iter_text_rows(f: BinaryIO, vector_size: int, keep: Set[str] = None,
+                       unicode_errors: str = 'replace') -> Iterable[Tuple[str, np.ndarray]]:
+        for line in f:
+            line = line.rstrip()
+            if not line:
+                continue
+            word, _, weights = line.partition(b' ')
+            word = Word2VecFormat.decode(word, unicode_errors)
+            if keep is not None and word not in keep:
+                continue
+            vector = np.fromstring(weights, dtype=real, sep=' ')
+            if len(vector) != vector_size:
+                raise ValueError(f"invalid vector of size {len(vector)} for word {word} (expected {vector_size})")
+            yield word, vector
+
+    @staticmethod
+    def iter_binary_rows(f: BinaryIO, vector_size: int, keep: Set[str] = None, unicode_errors: str = 'replace',
+                         chunk_size: int = 1 << 20) -> Iterable[Tuple[str, np.ndarray]]:
+        # rows are "<word> <vector_size float32 bytes>", optionally separated by newlines; skipped rows are only
+        # stepped over in the read buffer and never converted
+        bytes_per_vector = vector_size * np.dtype(real).itemsize
+        buffer = b''
+        position = 0
+        eof = False
+        while True:
+            space = buffer.find(b' ', position)
+            while (space == -1 or len(buffer) < space + 1 + bytes_per_vector) and not eof:
+                chunk = f.read(chunk_size)
+                eof = len(chunk) == 0
+                buffer = buffer[position:] + chunk
+                position = 0
+                space = buffer.find(b' ')
+            if space == -1 or len(buffer) < space + 1 + bytes_per_vector:
+                if buffer[position:].strip():
+                    raise EOFError("unexpected end of input; is count incorrect or file otherwise damaged?")
+                return
+            word = Word2VecFormat.decode(buffer[position:space].lstrip(b'\n'), unicode_errors)
+            start = space + 1
+            position = start + bytes_per_vector
+            if keep is None or word in keep:
+                yield word, np.frombuffer(buffer, dtype=real, count=vector_size, offset=start).copy()
+
+    @staticmethod
+    def load_restricted(path: str, keep: Set[str], binary: bool = False,
+                        unicode_errors: str = 'replace') -> Tuple[List[str], np.ndarray]:
+        with open(path, 'rb') as f:
+            vocab_size, vector_size = Word2VecFormat.read_header(f)
+            if binary:
+                rows = Word2VecFormat.iter_binary_rows(f, vector_size, keep, unicode_errors)
+            else:
+                rows = Word2VecFormat.iter_text_rows(f, vector_size, keep, unicode_errors)
+
+            vectors = np.empty((min(len(keep), vocab_size), vector_size), dtype=real)
+            words = []
+            seen = set()
+            for word, vector in rows:
+                if word in seen:
+                    continue
+                seen.add(word)
+                vectors[len(words)] = vector
+                words.append(word)
+                if len(words) == len(vectors):
+                    break
+
+        vectors.resize((len(words), vector_size), refcheck=False)
+        return words, vectors
+
+    @staticmethod
+    def line_aligned_chunks(path: str, start: int, chunk_size: int) -> List[Tuple[int, int]]:
+        size = os.path.getsize(path)
+        offsets = [start]
+        with open(path, 'rb') as f:
+            position = start + chunk_size
+            while position < size:
+                f.seek(position)
+                f.readline()
+                position = f.tell()
+                if position >= size:
+                    break
+                offsets.append(position)
+                position += chunk_size
+        offsets.append(size)
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    @staticmethod
+    def assemble_chunks(chunks: Iterable[Tuple[List[str], np.ndarray]], vocab_size: int,
+                        vector_size: int) -> Tuple[List[str], np.ndarray]:
+        vectors = np.empty((max(vocab_size, 1), vector_size), dtype=real)
+        words = []
+        for chunk_words, chunk_vectors in chunks:
+            rows = len(chunk_words)
+            if chunk_vectors.size != rows * vector_size:
+                raise ValueError(f"invalid vectors in chunk starting with word {chunk_words[:1]} "
+                                 f"(expected {vector_size} values per word)")
+            if len(words) + rows > len(vectors):
+                vectors.resize((max(2 * len(vectors), len(words) + rows), vector_size), refcheck=False)
+            vectors[len(words):len(words) + rows] = chunk_vectors.reshape(rows, vector_size)
+            words.extend(chunk_words)
+
+        if len(set(words)) != len(words):
+            # like gensim, ignore all but the first occurrence of a word
+            first_occurrences = {}
+            for i, word in enumerate(words):
+                first_occurrences.setdefault(word, i)
+            indices = np.fromiter(first_occurrences.values(), dtype=np.int64, count=len(first_occurrences))
+            vectors[:len(indices)] = vectors[indices]
+            words = list(first_occurrences.keys())
+
+        vectors.resize((len(words), vector_size), refcheck=False)
+        return words, vectors
+
+    @staticmethod
+    def parse_text_parallel(path: str, workers: int = None, chunk_size: int = 1 << 25,
+                            unicode_errors: str = 'replace') -> Tuple[List[str], np.ndarray]:
+        with open(path, 'rb') as f:
+            header = f.readline().split()
+            if len(header) == 2 and all(value.isdigit() for value in header):
+                vocab_size, vector_size = int(header[0]), int(header[1])
+                start = f.tell()
+            else:
+                # headerless file, the first line already is a vector
+                vocab_size, vector_size = 0, len(header) - 1
+                start = 0
+
+        tasks = [(path, chunk_start, chunk_end, unicode_errors)
+                 for chunk_start, chunk_end in Word2VecFormat.line_aligned_chunks(path, start, chunk_size)]
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(tasks))
+
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                return Word2VecFormat.assemble_chunks(pool.imap(_parse_text_chunk, tasks), vocab_size, vector_size)
+        return Word2VecFormat.assemble_chunks(map(_parse_text_chunk, tasks), vocab_size, vector_size)
+
+    @staticmethod
+    def write_text(path: str, words: List[str], vectors: np.ndarray):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f'{len(words)} {vectors.shape[1]}\n')
+            for word, row in zip(words, vectors):
+                f.write(f'{word} {" ".join("%.9g" % value for value in row)}\n')
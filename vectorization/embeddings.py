@@ -1,23 +1,29 @@
 import os
 from collections import defaultdict
+from itertools import chain, islice
 from multiprocessing.spawn import freeze_support
-from typing import List, Dict, Union
+from typing import List, Union, Tuple, Set, Iterable, Callable
 import gensim
 from flair.data import Dictionary, Sentence
 from flair.embeddings import TransformerWordEmbeddings, FlairEmbeddings
 from flair.trainers.language_model_trainer import TextCorpus, LanguageModelTrainer
 from gensim.test.utils import get_tmpfile
 from gensim.models import Phrases
+from gensim.models.keyedvectors import Vocab
 import glove
 from gensim.scripts.glove2word2vec import glove2word2vec
 import numpy as np
+import torch
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
 from numpy import float32 as real
-from gensim import utils
 from resource.UMLS import UMLSMapper
+from utils.corpus_shards import ShardedCorpus, ConcatenatedCorpus
+from utils.file_cache import FileCache
 from utils.transform_data import DataHandler
+from utils.w2v_format import Word2VecFormat
+from vectorization.quantization import QuantizedKeyedVectors
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -34,59 +40,6 @@ class Embeddings:
         cls.umls_mapper = UMLSMapper(from_dir=cls.config["PATH"]["UMLS"])
         return cls.umls_mapper
 
-    @classmethod
-    def to_gensim_binary(cls, dict_vecs: Dict[str, np.ndarray]) -> gensim.models.KeyedVectors:
-        def my_save_word2vec_format(fname: str, vocab: Dict[str, np.ndarray], vectors: np.ndarray, binary: bool = True,
-                                    total_vec: int = 2):
-            """Store the input-hidden weight matrix in the same format used by the original
-            C word2vec-tool, for compatibility.
-
-            Parameters
-            ----------
-            fname : str
-                The file path used to save the vectors in.
-            vocab : dict
-                The vocabulary of words.
-            vectors : numpy.array
-                The vectors to be stored.
-            binary : bool, optional
-                If True, the data wil be saved in binary word2vec format, else it will be saved in plain text.
-            total_vec : int, optional
-                Explicitly specify total number of vectors
-                (in case word vectors are appended with document vectors afterwards).
-
-            """
-            if not (vocab or vectors):
-                raise RuntimeError("no input")
-            if total_vec is None:
-                total_vec = len(vocab)
-            vector_size = vectors.shape[1]
-            assert (len(vocab), vector_size) == vectors.shape
-
-            with utils.open(fname, 'wb') as fout:
-                fout.write(utils.to_utf8("%s %s\n" % (total_vec, vector_size)))
-                # store in sorted order: most frequent words at the top
-                for word, row in vocab.items():
-                    if binary:
-                        row = row.astype(real)
-                        fout.write(utils.to_utf8(word) + b" " + row.tostring())
-                    else:
-                        fout.write(utils.to_utf8("%s %s\n" % (word, ' '.join(repr(val) for val in row))))
-
-        file_name = os.path.join(cls.config["PATH"]["InternalEmbeddings"], 'train.bin')
-        dim = 0
-        for vec in dict_vecs.values():
-            dim = len(vec)
-            break
-        m = gensim.models.keyedvectors.Word2VecKeyedVectors(vector_size=dim)
-        m.vocab = dict_vecs
-        m.vectors = np.array(list(dict_vecs.values()))
-        my_save_word2vec_format(binary=True, fname=file_name, total_vec=len(dict_vecs), vocab=m.vocab,
-                                vectors=m.vectors)
-        reloaded_vecs = gensim.models.keyedvectors.Word2VecKeyedVectors.load_word2vec_format(file_name, binary=True,
-                                                                                             unicode_errors="replace")
-        return reloaded_vecs
-
     @staticmethod
     def glove_vectors(sentences: List[List[str]],
                       window_size: int = 5,
@@ -99,12 +52,6 @@ class Embeddings:
                       alpha: float = 0.025,
                       x_max: int = 100) -> gensim.models.KeyedVectors:
 
-        def nan_checker(inp):
-            if np.isnan(inp) or inp == np.nan:
-                return 0.00000001
-            else:
-                return inp
-
         def build_co_occurrence_dict():
             d = defaultdict(lambda: defaultdict(int))
             vocab = {}
@@ -151,9 +98,10 @@ class Embeddings:
             epoch_bar.set_description("Glove epoch %d, error %.10f" % (epoch+1, err))
             epoch_bar.update()
 
-        vecs = [np.array([nan_checker(ele) for ele in vec]) for vec in model.W]
+        vectors = np.asarray(model.W, dtype=real)
+        vectors = np.where(np.isnan(vectors), real(0.00000001), vectors)
 
-        return Embeddings.to_gensim_binary({word: vector for word, vector in zip(vocabulary.keys(), vecs)})
+        return Embeddings.keyed_vectors_from_arrays(list(vocabulary.keys()), vectors)
 
     @staticmethod
     def calculate_vectors(sentences=List[str],
@@ -191,29 +139,31 @@ class Embeddings:
         return model.wv
 
     @staticmethod
-    def restrict_vectors(wordvectors: gensim.models.KeyedVectors, restricted_word_set):
-        new_vectors = []
+    def restrict_vectors(wordvectors: gensim.models.KeyedVectors, restricted_word_set, save_path: str = None):
+        indices = np.fromiter((i for i, word in enumerate(wordvectors.index2entity) if word in restricted_word_set),
+                              dtype=np.int64)
+        new_index2entity = [wordvectors.index2entity[i] for i in indices]
         new_vocab = {}
-        new_index2entity = []
-        new_vectors_norm = []
-        wordvectors.init_sims()
-        for i in tqdm(range(len(wordvectors.vocab)), desc="Vector restriction", total=len(wordvectors.vocab)):
-            word = wordvectors.index2entity[i]
-            vec = wordvectors.vectors[i]
+        for new_index, word in enumerate(new_index2entity):
             vocab = wordvectors.vocab[word]
-            vec_norm = wordvectors.vectors_norm[i]
-            if word in restricted_word_set:
-                vocab.index = len(new_index2entity)
-                new_index2entity.append(word)
-                new_vocab[word] = vocab
-                new_vectors.append(vec)
-                new_vectors_norm.append(vec_norm)
-
+            vocab.index = new_index
+            new_vocab[word] = vocab
+
+        # fancy indexing only copies the kept rows (and only reads them if the vectors are memory-mapped);
+        # normalized vectors are taken over if already computed and otherwise computed lazily for the subset
+        wordvectors.vectors = np.asarray(wordvectors.vectors[indices])
+        if getattr(wordvectors, 'vectors_norm', None) is not None:
+            wordvectors.vectors_norm = np.asarray(wordvectors.vectors_norm[indices])
+        if getattr(wordvectors, 'scales', None) is not None:
+            wordvectors.scales = wordvectors.scales[indices]
+        if getattr(wordvectors, 'norms', None) is not None:
+            wordvectors.norms = wordvectors.norms[indices]
         wordvectors.vocab = new_vocab
-        wordvectors.vectors = np.array(new_vectors)
         wordvectors.index2entity = new_index2entity
         wordvectors.index2word = new_index2entity
-        wordvectors.vectors_norm = new_vectors_norm
+
+        if save_path:
+            Embeddings.save(wordvectors, path=save_path)
 
     @staticmethod
     def save(word_vectors: gensim.models.KeyedVectors, path: str):
@@ -233,42 +183,150 @@ class Embeddings:
                 print('No UMLS defined yet. Build UMLSMapper...')
                 cls.umls_mapper = UMLSMapper(from_dir=cls.config["PATH"]["UMLS"])
             concept_vecs = cls.umls_mapper.get_umls_vectors_only(word_vectors)
-            Embeddings.restrict_vectors(word_vectors, concept_vecs.keys())
-            Embeddings.save(word_vectors, path=save_path_med)
+            Embeddings.restrict_vectors(word_vectors, concept_vecs.keys(), save_path=save_path_med)
             print(f'Restricted to {len(word_vectors.vocab)} vectors')
 
+    @staticmethod
+    def save_quantized(word_vectors: gensim.models.KeyedVectors, path: str, quantization: str = "int8"):
+        if not isinstance(word_vectors, QuantizedKeyedVectors):
+            word_vectors = QuantizedKeyedVectors.from_keyed_vectors(word_vectors, quantization)
+        word_vectors.save_npz(path)
+
+    @staticmethod
+    def load_quantized(path: str) -> QuantizedKeyedVectors:
+        print(f"load quantized embedding of file {path}...")
+        return QuantizedKeyedVectors.load_npz(path)
+
     @staticmethod
     def load_keyed_vecs(path: str) -> gensim.models.KeyedVectors:
         print(f"load embedding of file {path}...")
         return gensim.models.KeyedVectors.load(path)
 
     @staticmethod
-    def load_w2v_format(path: str, binary=False) -> gensim.models.KeyedVectors:
+    def keyed_vectors_from_arrays(words: List[str], vectors: np.ndarray) -> gensim.models.KeyedVectors:
+        keyed_vecs = gensim.models.keyedvectors.Word2VecKeyedVectors(vector_size=vectors.shape[1])
+        keyed_vecs.vectors = vectors
+        keyed_vecs.index2word = list(words)
+        vocab_size = len(keyed_vecs.index2word)
+        keyed_vecs.vocab = {word: Vocab(index=i, count=vocab_size - i) for i, word in enumerate(keyed_vecs.index2word)}
+        return keyed_vecs
+
+    @staticmethod
+    def write_vocab(path: str, words: List[str]):
+        # newline='' keeps a '\r' inside a token (legal in w2v files) from being translated on write or read
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write('\n'.join(words))
+
+    @staticmethod
+    def read_vocab(path: str) -> List[str]:
+        with open(path, encoding='utf-8', newline='') as f:
+            content = f.read()
+        return content.split('\n') if content else []
+
+    @staticmethod
+    def w2v_cache_paths(path: str) -> Tuple[str, str]:
+        return f'{path}.npy', f'{path}.vocab'
+
+    @classmethod
+    def write_w2v_cache(cls, keyed_vecs: gensim.models.KeyedVectors, path: str, binary: bool):
+        matrix_path, vocab_path = cls.w2v_cache_paths(path)
+
+        def writer(cache_path: str):
+            with open(cache_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(keyed_vecs.vectors, dtype=real))
+            cls.write_vocab(vocab_path, keyed_vecs.index2word)
+
+        if FileCache.write(matrix_path, path, writer, binary=int(binary)):
+            print(f"cached embedding of file {path} as {matrix_path}")
+
+    @classmethod
+    def load_w2v_cache(cls, path: str) -> Union[gensim.models.KeyedVectors, None]:
+        matrix_path, vocab_path = cls.w2v_cache_paths(path)
+        print(f"load cached embedding of file {path}...")
+        vectors = np.load(matrix_path, mmap_mode='c')
+        words = cls.read_vocab(vocab_path)
+        if len(words) != vectors.shape[0]:
+            print(f"ignore cached embedding of file {path}: {len(words)} words for {vectors.shape[0]} vectors")
+            return None
+        return cls.keyed_vectors_from_arrays(words, vectors)
+
+    @classmethod
+    def has_w2v_cache(cls, path: str, binary: bool) -> bool:
+        matrix_path, vocab_path = cls.w2v_cache_paths(path)
+        return os.path.exists(vocab_path) and FileCache.is_valid(matrix_path, path, binary=int(binary))
+
+    @classmethod
+    def load_w2v_format(cls, path: str, binary=False, use_cache: bool = True) -> gensim.models.KeyedVectors:
+        if use_cache and cls.has_w2v_cache(path, binary):
+            keyed_vecs = cls.load_w2v_cache(path)
+            if keyed_vecs is not None:
+                return keyed_vecs
         print(f"load embedding of file {path}...")
-        return gensim.models.KeyedVectors.load_word2vec_format(path, binary=binary, unicode_errors='replace')
+        if binary:
+            keyed_vecs = gensim.models.KeyedVectors.load_word2vec_format(path, binary=True, unicode_errors='replace')
+        else:
+            keyed_vecs = cls.keyed_vectors_from_arrays(*Word2VecFormat.parse_text_parallel(path))
+        if use_cache:
+            cls.write_w2v_cache(keyed_vecs, path, binary)
+        return keyed_vecs
+
+    @classmethod
+    def load_w2v_format_restricted(cls, path: str, keep: Set[str], binary=False) -> gensim.models.KeyedVectors:
+        keyed_vecs = cls.load_w2v_cache(path) if cls.has_w2v_cache(path, binary) else None
+        if keyed_vecs is not None:
+            indices = [i for i, word in enumerate(keyed_vecs.index2word) if word in keep]
+            words = [keyed_vecs.index2word[i] for i in indices]
+            vectors = np.asarray(keyed_vecs.vectors[indices])
+        else:
+            print(f"load embedding of file {path} restricted to {len(keep)} entries...")
+            words, vectors = Word2VecFormat.load_restricted(path, keep, binary=binary)
+        print(f"kept {len(words)} vectors")
+        return cls.keyed_vectors_from_arrays(words, vectors)
 
     @classmethod
-    def load(cls, path: str = None, file: str = None, internal: bool = True, estimate_cui=False) \
-            -> gensim.models.KeyedVectors:
+    def load(cls, path: str = None, file: str = None, internal: bool = True, estimate_cui=False,
+             restrict_to_umls: bool = False, quantization: str = None) -> gensim.models.KeyedVectors:
         if file:
             if internal:
                 use_folder = 'InternalEmbeddings'
             else:
                 use_folder = 'ExternalEmbeddings'
             path = os.path.join(cls.config['PATH'][use_folder], file)
-        if path.endswith('_b.kv'):
-            keyed_vecs = cls.load_w2v_format(path, binary=True)
+
+        keep = None
+        if restrict_to_umls:
+            if cls.umls_mapper is None:
+                print('No UMLS defined yet. Build UMLSMapper...')
+                cls.umls_mapper = UMLSMapper(from_dir=cls.config["PATH"]["UMLS"])
+            # with estimate_cui the tokens of UMLS terms are needed to compose the concept vectors
+            keep = cls.umls_mapper.vocabulary_keep_set(include_term_tokens=estimate_cui)
+
+        if path.endswith('_b.kv') or path.endswith('.model'):
+            if keep is None:
+                keyed_vecs = cls.load_w2v_format(path, binary=True)
+            else:
+                keyed_vecs = cls.load_w2v_format_restricted(path, keep, binary=True)
         elif path.endswith('.kv'):
             keyed_vecs = cls.load_keyed_vecs(path)
+            if keep is not None:
+                cls.restrict_vectors(keyed_vecs, keep)
         elif path.endswith('.txt'):
-            keyed_vecs = cls.load_w2v_format(path)
-        elif path.endswith('.model'):
-            keyed_vecs = cls.load_w2v_format(path, binary=True)
+            if keep is None:
+                keyed_vecs = cls.load_w2v_format(path)
+            else:
+                keyed_vecs = cls.load_w2v_format_restricted(path, keep)
+        elif path.endswith('.npz'):
+            keyed_vecs = cls.load_quantized(path)
+            if keep is not None:
+                cls.restrict_vectors(keyed_vecs, keep)
         else:
-            raise UserWarning('Not supported Embedding type (not .kv or .txt)')
+            raise UserWarning('Not supported Embedding type (not .kv, .txt or .npz)')
 
         if estimate_cui:
-            keyed_vecs = cls.assign_concepts_to_vecs(keyed_vecs)
+            keyed_vecs = cls.assign_concepts_to_vecs(keyed_vecs, path=path)
+
+        if quantization and not isinstance(keyed_vecs, QuantizedKeyedVectors):
+            keyed_vecs = QuantizedKeyedVectors.from_keyed_vectors(keyed_vecs, quantization)
 
         return keyed_vecs
 
@@ -277,30 +335,128 @@ class Embeddings:
         glove2word2vec(glove_input_file, word2vec_output_file)
 
     @classmethod
-    def assign_concepts_to_vecs(cls, vectors: gensim.models.KeyedVectors):
+    def estimate_concept_vectors(cls, vectors: gensim.models.KeyedVectors) -> Tuple[List[str], np.ndarray]:
+        tokens, term_tokens, concept_terms = cls.umls_mapper.concept_composition_matrices()
+
+        token_rows = np.fromiter((vectors.vocab[token].index if token in vectors.vocab else -1 for token in tokens),
+                                 dtype=np.int64, count=len(tokens))
+        present_columns = np.flatnonzero(token_rows >= 0)
+        # a term only counts if all of its tokens are in the vocab
+        missing_tokens = term_tokens @ (token_rows < 0).astype(real)
+        valid_terms = np.flatnonzero(missing_tokens == 0)
+
+        if isinstance(vectors, QuantizedKeyedVectors):
+            token_vectors = vectors.dequantize_indices(token_rows[present_columns])
+        else:
+            token_vectors = np.asarray(vectors.vectors[token_rows[present_columns]], dtype=real)
+        valid_concept_terms = concept_terms[:, valid_terms]
+        term_vectors = term_tokens[valid_terms][:, present_columns] @ token_vectors
+        concept_sums = valid_concept_terms @ term_vectors
+        term_counts = np.asarray(valid_concept_terms.sum(axis=1)).ravel()
+
+        concept_rows = [row for row in np.flatnonzero(term_counts > 0)
+                        if cls.umls_mapper.cuis[row] not in vectors.vocab]
+        concepts = [cls.umls_mapper.cuis[row] for row in concept_rows]
+        return concepts, (concept_sums[concept_rows] / term_counts[concept_rows, None]).astype(real)
+
+    @staticmethod
+    def estimated_cui_cache_paths(path: str) -> Tuple[str, str]:
+        return f'{path}.cui.npy', f'{path}.cui.vocab'
+
+    @classmethod
+    def write_estimated_cui_cache(cls, path: str, concepts: List[str], concept_vectors: np.ndarray):
+        matrix_path, vocab_path = cls.estimated_cui_cache_paths(path)
+
+        def writer(cache_path: str):
+            with open(cache_path, 'wb') as f:
+                np.save(f, concept_vectors)
+            cls.write_vocab(vocab_path, concepts)
+
+        if FileCache.write(matrix_path, path, writer, mapper=cls.umls_mapper.fingerprint()):
+            print(f"cached {len(concepts)} estimated concept vectors of file {path} as {matrix_path}")
+
+    @classmethod
+    def load_estimated_cui_cache(cls, path: str) -> Union[Tuple[List[str], np.ndarray], None]:
+        matrix_path, vocab_path = cls.estimated_cui_cache_paths(path)
+        if not (os.path.exists(vocab_path)
+                and FileCache.is_valid(matrix_path, path, mapper=cls.umls_mapper.fingerprint())):
+            return None
+        print(f"load cached estimated concept vectors of file {path}...")
+        concepts = cls.read_vocab(vocab_path)
+        concept_vectors = np.load(matrix_path, mmap_mode='r')
+        if len(concepts) != concept_vectors.shape[0]:
+            print(f"ignore cached estimated concept vectors of file {path}: "
+                  f"{len(concepts)} concepts for {concept_vectors.shape[0]} vectors")
+            return None
+        return concepts, concept_vectors
+
+    @staticmethod
+    def append_vectors(vectors: gensim.models.KeyedVectors, words: List[str], new_vectors: np.ndarray):
+        if isinstance(vectors, QuantizedKeyedVectors):
+            vectors.add(words, new_vectors)
+            return
+        # one allocation for the joined matrix instead of the vstack + vectors_norm handling of KeyedVectors.add
+        previous_vocab_len = len(vectors.index2word)
+        joined = np.empty((previous_vocab_len + len(words), vectors.vector_size), dtype=real)
+        joined[:previous_vocab_len] = vectors.vectors
+        joined[previous_vocab_len:] = new_vectors
+        vectors.vectors = joined
+        for i, word in enumerate(words):
+            vectors.vocab[word] = Vocab(index=previous_vocab_len + i, count=1)
+            vectors.index2word.append(word)
+        vectors.vectors_norm = None
+
+    @classmethod
+    def assign_concepts_to_vecs(cls, vectors: gensim.models.KeyedVectors, path: str = None):
         if cls.umls_mapper is None:
             print('No UMLS defined yet. Build UMLSMapper...')
             cls.umls_mapper = UMLSMapper(from_dir=cls.config["PATH"]["UMLS"])
-        addable_concepts = []
-        addable_vectors = []
-        for concept, terms in cls.umls_mapper.umls_reverse_dict.items():
-            concept_vec = []
-            for term in terms:
-                term_tokens = term.split()
-                token_vecs = []
-                for token in term_tokens:
-                    if token in vectors.vocab:
-                        token_vecs.append(vectors.get_vector(token))
-                if len(term_tokens) == len(token_vecs):
-                    term_vector = sum(token_vecs)
-                    concept_vec.append(term_vector)
-            if len(concept_vec) > 0:
-                addable_concepts.append(concept)
-                addable_vectors.append(sum(concept_vec) / len(concept_vec))
-        vectors.add(addable_concepts, addable_vectors)
 
+        # the estimated block only depends on the embedding file and the UMLS mapping, so it is cached next to the
+        # embedding and reused by later loads
+        cached = cls.load_estimated_cui_cache(path) if path else None
+        if cached is None:
+            concepts, concept_vectors = cls.estimate_concept_vectors(vectors)
+            if path:
+                cls.write_estimated_cui_cache(path, concepts, concept_vectors)
+        else:
+            concepts, concept_vectors = cached
+            # vocab restrictions keep all CUIs, but skip any that are already part of the embedding anyway
+            if any(concept in vectors.vocab for concept in concepts):
+                rows = [i for i, concept in enumerate(concepts) if concept not in vectors.vocab]
+                concepts, concept_vectors = [concepts[i] for i in rows], concept_vectors[rows]
+
+        cls.append_vectors(vectors, concepts, concept_vectors)
         return vectors
 
+    @staticmethod
+    def cached_preprocessing(paths: List[str], cache_dir: str,
+                             preprocess: Callable[[Iterable[str]], Iterable[Union[List[str], str]]], mode: str,
+                             number_sentences: int = None) -> ConcatenatedCorpus:
+        # every input file is preprocessed into its own shard directory, addressed by the content hash of the file and
+        # the preprocessing mode, so corpora concatenated from several files reuse the shards of the single corpora
+        corpora = []
+        remaining = number_sentences
+        for path in paths:
+            if remaining is not None and remaining <= 0:
+                break
+            content_hash = FileCache.memoized_hash(path, cache_dir)
+            corpus_dir = os.path.join(cache_dir, FileCache.hash_strings(content_hash, mode))
+            if not ShardedCorpus.is_complete(corpus_dir) and remaining is not None:
+                # a prefix of the file is only cached under its own key, the full file cache is preferred above
+                corpus_dir = os.path.join(cache_dir, FileCache.hash_strings(content_hash, mode, remaining))
+
+            if ShardedCorpus.is_complete(corpus_dir):
+                print(f"load preprocessed {path} from {corpus_dir}...")
+                corpus = ShardedCorpus(corpus_dir)
+            else:
+                sentences = islice(DataHandler.iter_lines(path), remaining)
+                corpus = ShardedCorpus.write(tqdm(preprocess(sentences), desc=f"Preprocess {path}"), corpus_dir)
+            corpora.append(corpus)
+            if remaining is not None:
+                remaining -= len(corpus)
+        return ConcatenatedCorpus(corpora, limit=number_sentences)
+
     @classmethod
     def sentence_data2vec(cls, path: Union[str, List[str]], embedding_name: str,
                           embeddings_algorithm: Union[str, gensim.models.Word2Vec, gensim.models.FastText] = "word2vec",
@@ -309,6 +465,10 @@ class Embeddings:
                           restrict_vectors: bool = False,
                           umls_replacement: bool = True,
                           use_multiterm_replacement: bool = True,
+                          multiterm_engine: str = "spacy",
+                          n_process: int = 1,
+                          shard_dir: str = None,
+                          preprocessing_cache: str = None,
                           flair_model_path: str = None,
                           flair_corpus_path: str = None,
                           flair_algorithm: str = 'de-forward'
@@ -323,14 +483,6 @@ class Embeddings:
         if isinstance(embeddings_algorithm, str) and embeddings_algorithm.lower() == "flair":
             is_flair = True
 
-        if isinstance(path, list):
-            data_sentences = DataHandler.concat_path_sentences(path)
-        else:
-            data_sentences = DataHandler.lines_from_file(path=path)
-        if number_sentences:
-            data_sentences = data_sentences[:number_sentences]
-        print((data_sentences[:10]))
-
         # cpg_words = lines_from_file(path="E:/AML4DH-DATA/CPG-AMIA2020/Plain Text/cpg-tokens.txt")
 
         # Preprocessing
@@ -339,27 +491,53 @@ class Embeddings:
         # cpg_words = DataHandler.preprocess(cpg_words)
         # print((cpg_words[:100]))
 
-        # data_sentences = umls_mapper.standardize_documents(data_sentences)
+        # data_sentences = list(umls_mapper.standardize_documents(data_sentences))
         # data_sentences = umls_mapper.replace_documents_with_umls(data_sentences)
         # sents = [data_sentences[20124], data_sentences[20139]]
         tokenize = True
         if flair_model_path:
             tokenize = False
-        if umls_replacement:
-            if cls.umls_mapper is None:
-                print('No UMLS defined yet. Build UMLSMapper...')
-                cls.umls_mapper = UMLSMapper(from_dir=cls.config["PATH"]["UMLS"])
+        if umls_replacement and cls.umls_mapper is None:
+            print('No UMLS defined yet. Build UMLSMapper...')
+            cls.umls_mapper = UMLSMapper(from_dir=cls.config["PATH"]["UMLS"])
 
+        def preprocess(sentences: Iterable[str]) -> Iterable[Union[List[str], str]]:
+            if not umls_replacement:
+                return UMLSMapper.iter_spacy_tokenize(sentences, n_process=n_process)
+            if use_multiterm_replacement and multiterm_engine == "aho_corasick":
+                return cls.umls_mapper.multiterm_matcher.replace_documents(sentences, tokenize=tokenize)
             if use_multiterm_replacement:
-                data_sentences = cls.umls_mapper.replace_documents_with_spacy_multiterm(data_sentences,
-                                                                                        tokenize=tokenize)
-            else:
-                data_sentences = cls.umls_mapper.replace_documents_token_based(data_sentences, tokenize=tokenize)
-            print(data_sentences[:10])
+                return cls.umls_mapper.iter_replace_documents_with_spacy_multiterm(sentences, tokenize=tokenize,
+                                                                                   n_process=n_process)
+            return cls.umls_mapper.iter_replace_documents_token_based(sentences, tokenize=tokenize)
+
+        paths = path if isinstance(path, list) else [path]
+        if preprocessing_cache:
+            mode = [umls_replacement, use_multiterm_replacement and multiterm_engine, tokenize]
+            if umls_replacement:
+                mode.append(cls.umls_mapper.fingerprint())
+            data_sentences = cls.cached_preprocessing(paths, preprocessing_cache, preprocess,
+                                                      mode=FileCache.hash_strings(*mode),
+                                                      number_sentences=number_sentences)
+            print(data_sentences.head(10))
+        elif shard_dir:
+            # the corpus is streamed from the files through the preprocessing into shards on disk
+            data_sentences = chain.from_iterable(DataHandler.iter_lines(sentence_path) for sentence_path in paths)
+            if number_sentences:
+                data_sentences = islice(data_sentences, number_sentences)
+            data_sentences = ShardedCorpus.write(tqdm(preprocess(data_sentences), desc="Preprocess"), shard_dir)
+            print(data_sentences.head(10))
         else:
-            data_sentences = cls.umls_mapper.spacy_tokenize(data_sentences)
+            data_sentences = DataHandler.concat_path_sentences(paths)
+            if number_sentences:
+                data_sentences = data_sentences[:number_sentences]
+            print((data_sentences[:10]))
+            data_sentences = list(tqdm(preprocess(data_sentences), desc="Preprocess", total=len(data_sentences)))
             print(data_sentences[:10])
 
+        if is_flair and not isinstance(data_sentences, list):
+            data_sentences = list(data_sentences)
+
         if is_flair:
             vecs = Flair.get_flair_vectors(data_sentences,
                                            flair_model_path=flair_model_path,
@@ -377,7 +555,8 @@ class Embeddings:
 
 class Embedding:
     def __init__(self, file: str, dataset: str, algorithm: str, preprocessing: str,
-                 internal: bool = True, estimate_cui: bool = False, is_file: bool = True):
+                 internal: bool = True, estimate_cui: bool = False, is_file: bool = True,
+                 restrict_to_umls: bool = False, quantization: str = None):
         self.path = file
         self.dataset = dataset
         self.algorithm = algorithm
@@ -385,17 +564,23 @@ class Embedding:
         self.internal = internal
         self.estimate_cui = estimate_cui
         self.is_file = is_file
+        self.restrict_to_umls = restrict_to_umls
+        self.quantization = quantization
         self.vectors = None
 
     def load(self):
         if self.is_file:
             self.vectors = Embeddings.load(file=self.path,
                                            internal=self.internal,
-                                           estimate_cui=self.estimate_cui)
+                                           estimate_cui=self.estimate_cui,
+                                           restrict_to_umls=self.restrict_to_umls,
+                                           quantization=self.quantization)
         else:
             self.vectors = Embeddings.load(path=self.path,
                                            internal=self.internal,
-                                           estimate_cui=self.estimate_cui)
+                                           estimate_cui=self.estimate_cui,
+                                           restrict_to_umls=self.restrict_to_umls,
+                                           quantization=self.quantization)
 
     def clean(self):
         del self.vectors
@@ -539,9 +724,9 @@ class Flair:
                 else:
                     keyed_vecs[token.text] = (token.embedding.cpu(), 1)
             flair_sentence.clear_embeddings()
-        keyed_vecs = {key: np.array(vecs[0]) for key, vecs in keyed_vecs.items()}
-        keyed_vecs = {key: vecs for key, vecs in keyed_vecs.items() if len(vecs) != 0}
+        keyed_vecs = {key: vecs[0] for key, vecs in keyed_vecs.items() if len(vecs[0]) != 0}
         # for key, vec in keyed_vecs.items():
         #     if len(vec) != 3072:
         #         print(key, len(vec))
-        return Embeddings.to_gensim_binary(keyed_vecs)
+        vectors = torch.stack(list(keyed_vecs.values())).detach().numpy().astype(real, copy=False)
+        return Embeddings.keyed_vectors_from_arrays(list(keyed_vecs.keys()), vectors)
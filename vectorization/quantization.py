@@ -0,0 +1,154 @@
+from typing import List, Tuple, Union
+import numpy as np
+from gensim import matutils
+from gensim.models.keyedvectors import Vocab, Word2VecKeyedVectors
+from numpy import float32 as real
+
+QUANTIZATIONS = ("float16", "int8")
+
+
+def quantize(vectors: np.ndarray, quantization: str) -> Tuple[np.ndarray, Union[np.ndarray, None]]:
+    if quantization == "float16":
+        return np.asarray(vectors, dtype=np.float16), None
+    if quantization == "int8":
+        # symmetric per-row scaling, every row uses the full int8 range
+        scales = np.abs(vectors).max(axis=1).astype(real) / 127
+        scales[scales == 0] = 1
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales
+    raise UserWarning(f'Not supported quantization {quantization} (not one of {QUANTIZATIONS})')
+
+
+def dequantize(vectors: np.ndarray, scales: Union[np.ndarray, None]) -> np.ndarray:
+    if scales is None:
+        return vectors.astype(real)
+    return vectors.astype(real) * scales[:, None]
+
+
+class QuantizedKeyedVectors(Word2VecKeyedVectors):
+    # Keeps the vectors as float16 or per-row scaled int8 and only dequantizes tiles of rows when similarities over
+    # the whole vocabulary are needed, so no float32 copy of the matrix (or of vectors_norm) is ever materialized.
+    def __init__(self, vector_size: int, quantization: str = "int8", tile_size: int = 65536):
+        super().__init__(vector_size=vector_size)
+        self.quantization = quantization
+        self.tile_size = tile_size
+        self.scales = None
+        self.norms = None
+
+    @classmethod
+    def from_arrays(cls, words: List[str], vectors: np.ndarray, scales: Union[np.ndarray, None],
+                    quantization: str) -> "QuantizedKeyedVectors":
+        keyed_vecs = cls(vector_size=vectors.shape[1], quantization=quantization)
+        keyed_vecs.vectors = vectors
+        keyed_vecs.scales = scales
+        keyed_vecs.index2word = list(words)
+        vocab_size = len(keyed_vecs.index2word)
+        keyed_vecs.vocab = {word: Vocab(index=i, count=vocab_size - i) for i, word in enumerate(keyed_vecs.index2word)}
+        return keyed_vecs
+
+    @classmethod
+    def from_keyed_vectors(cls, keyed_vecs: Word2VecKeyedVectors, quantization: str) -> "QuantizedKeyedVectors":
+        vectors, scales = quantize(np.asarray(keyed_vecs.vectors, dtype=real), quantization)
+        return cls.from_arrays(keyed_vecs.index2word, vectors, scales, quantization)
+
+    def save_npz(self, path: str):
+        np.savez(path,
+                 words=np.array(self.index2word),
+                 vectors=self.vectors,
+                 scales=self.scales if self.scales is not None else np.empty(0, dtype=real),
+                 quantization=np.array(self.quantization))
+
+    @classmethod
+    def load_npz(cls, path: str) -> "QuantizedKeyedVectors":
+        with np.load(path, allow_pickle=False) as data:
+            scales = data["scales"] if len(data["scales"]) > 0 else None
+            return cls.from_arrays(data["words"].tolist(), data["vectors"], scales, str(data["quantization"]))
+
+    def dequantize_rows(self, start: int, end: int) -> np.ndarray:
+        return dequantize(self.vectors[start:end], None if self.scales is None else self.scales[start:end])
+
+    def dequantize_indices(self, indices: np.ndarray) -> np.ndarray:
+        return dequantize(self.vectors[indices], None if self.scales is None else self.scales[indices])
+
+    def word_vec(self, word, use_norm=False):
+        if word not in self.vocab:
+            raise KeyError("word '%s' not in vocabulary" % word)
+        index = self.vocab[word].index
+        result = self.dequantize_rows(index, index + 1)[0]
+        if use_norm:
+            self.init_sims()
+            result /= self.norms[index]
+        result.setflags(write=False)
+        return result
+
+    def init_sims(self, replace=False):
+        if self.norms is None:
+            norms = np.empty(len(self.vectors), dtype=real)
+            for start in range(0, len(self.vectors), self.tile_size):
+                end = min(start + self.tile_size, len(self.vectors))
+                norms[start:end] = np.linalg.norm(self.dequantize_rows(start, end), axis=1)
+            norms[norms == 0] = 1
+            self.norms = norms
+
+    def most_similar(self, positive=None, negative=None, topn=10, restrict_vocab=None, indexer=None):
+        if isinstance(topn, int) and topn < 1:
+            return []
+        if positive is None:
+            positive = []
+        if negative is None:
+            negative = []
+        if isinstance(positive, str) and not negative:
+            positive = [positive]
+        positive = [(word, 1.0) if isinstance(word, (str, np.ndarray)) else word for word in positive]
+        negative = [(word, -1.0) if isinstance(word, (str, np.ndarray)) else word for word in negative]
+
+        self.init_sims()
+        all_words, mean = set(), []
+        for word, weight in positive + negative:
+            if isinstance(word, np.ndarray):
+                mean.append(weight * word)
+            else:
+                mean.append(weight * self.word_vec(word, use_norm=True))
+                if word in self.vocab:
+                    all_words.add(self.vocab[word].index)
+        if not mean:
+            raise ValueError("cannot compute similarity with no input")
+        mean = matutils.unitvec(np.array(mean).mean(axis=0)).astype(real)
+
+        limit = len(self.vectors) if restrict_vocab is None else min(restrict_vocab, len(self.vectors))
+        dists = np.empty(limit, dtype=real)
+        for start in range(0, limit, self.tile_size):
+            end = min(start + self.tile_size, limit)
+            dists[start:end] = np.dot(self.dequantize_rows(start, end), mean) / self.norms[start:end]
+
+        if not topn:
+            return dists
+        best = matutils.argsort(dists, topn=topn + len(all_words), reverse=True)
+        result = [(self.index2word[sim], float(dists[sim])) for sim in best if sim not in all_words]
+        return result[:topn]
+
+    def add(self, entities, weights, replace=False):
+        if isinstance(entities, str):
+            entities = [entities]
+            weights = np.array(weights).reshape(1, -1)
+        weights = np.asarray(weights, dtype=real)
+        if len(entities) == 0:
+            return
+
+        in_vocab = np.array([entity in self.vocab for entity in entities], dtype=bool)
+        if replace and in_vocab.any():
+            indices = [self.vocab[entity].index for entity, known in zip(entities, in_vocab) if known]
+            replaced_vectors, replaced_scales = quantize(weights[in_vocab], self.quantization)
+            self.vectors[indices] = replaced_vectors
+            if self.scales is not None:
+                self.scales[indices] = replaced_scales
+
+        entities = [entity for entity, known in zip(entities, in_vocab) if not known]
+        new_vectors, new_scales = quantize(weights[~in_vocab], self.quantization)
+        previous_vocab_len = len(self.vocab)
+        self.vectors = np.vstack((self.vectors, new_vectors))
+        if self.scales is not None:
+            self.scales = np.concatenate((self.scales, new_scales))
+        for i, entity in enumerate(entities):
+            self.vocab[entity] = Vocab(index=previous_vocab_len + i, count=1)
+            self.index2word.append(entity)
+        self.norms = None